@@ -1,19 +1,73 @@
+import asyncio
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from . import metrics
 
 SECRET_KEY = "your-secret-key"  # In a real app, use a more secure key and load it from env variables
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", 32))
+
+# Admin endpoints are disabled unless a token is configured
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so a few threads hash in parallel without touching the event loop.
+# The semaphore bounds running plus queued operations so a login burst fails fast instead of
+# piling up behind the workers.
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_SIZE)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    with metrics.password_hash_duration.time(("verify",)):
+        return pwd_context.verify(plain_password, hashed_password)
+
+def verify_and_update_password(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    """
+    Verifies a password and, if the hash was made with other settings than the configured
+    ones (e.g. a different bcrypt cost), also returns a new hash to store.
+    """
+    with metrics.password_hash_duration.time(("verify",)):
+        return pwd_context.verify_and_update(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    with metrics.password_hash_duration.time(("hash",)):
+        return pwd_context.hash(password)
+
+async def _run_hash_task(func, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise PasswordHasherBusy()
+    try:
+        future = _hash_executor.submit(func, *args)
+    except BaseException:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    return await asyncio.wrap_future(future)
+
+async def verify_and_update_password_async(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    return await _run_hash_task(verify_and_update_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_hash_task(get_password_hash, password)
+
+def is_admin_token(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
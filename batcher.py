@@ -0,0 +1,167 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from . import database
+
+WRITE_BATCHING = os.getenv("WRITE_BATCHING", "0") == "1"
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", 5))
+WRITE_BATCH_MAX_SIZE = int(os.getenv("WRITE_BATCH_MAX_SIZE", 256))
+
+_STOP = object()
+
+
+class _Write:
+    __slots__ = ("fn", "args", "kwargs", "future")
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class WriteBatcher:
+    """
+    Group-commits writes from concurrent callers.
+
+    Each write is a function called as `fn(session, *args, **kwargs)` that adds and flushes
+    rows but does not commit. Writes submitted within `window` seconds of the first one in a
+    batch (up to `max_size` of them) run in one session and are committed together, so a
+    burst of inserts costs one transaction instead of one each. The future returned by
+    `submit` resolves to the function's return value once its batch has committed.
+
+    If any write in a batch fails, the batch is rolled back and its writes are retried one
+    transaction each, so a failing write only fails its own caller.
+
+    Sessions do not expire on commit, so returned rows can be read after their session
+    is closed.
+    """
+
+    def __init__(self, session_factory: Callable, window: float, max_size: int):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_size = max_size
+        self.batches_committed = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        write = _Write(fn, args, kwargs)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Write batcher is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-batcher", daemon=True)
+                self._thread.start()
+            self._queue.put(write)
+        return write.future
+
+    def write(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Submits a write and waits for its batch to commit.
+        """
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def write_async(self, fn: Callable, *args, **kwargs) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch: List[_Write]):
+        batch = [write for write in batch if write.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        if len(batch) > 1:
+            results = self._try_commit(batch)
+            if results is not None:
+                for write, result in zip(batch, results):
+                    write.future.set_result(result)
+                return
+        for write in batch:
+            try:
+                results = self._try_commit([write], raise_errors=True)
+            except BaseException as exc:
+                write.future.set_exception(exc)
+            else:
+                write.future.set_result(results[0])
+
+    def _try_commit(self, batch: List[_Write], raise_errors: bool = False) -> Optional[list]:
+        db = self.session_factory()
+        try:
+            results = [write.fn(db, *write.args, **write.kwargs) for write in batch]
+            db.commit()
+        except BaseException:
+            db.rollback()
+            if raise_errors:
+                raise
+            return None
+        finally:
+            db.close()
+        self.batches_committed += 1
+        return results
+
+    def close(self):
+        """
+        Stops accepting writes and waits for the pending ones to commit.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join()
+
+
+_write_batcher = None
+_write_batcher_lock = threading.Lock()
+
+
+def get_write_batcher() -> WriteBatcher:
+    global _write_batcher
+    with _write_batcher_lock:
+        if _write_batcher is None:
+            _write_batcher = WriteBatcher(
+                session_factory=sessionmaker(bind=database.engine, autoflush=False, expire_on_commit=False),
+                window=WRITE_BATCH_WINDOW_MS / 1000,
+                max_size=WRITE_BATCH_MAX_SIZE,
+            )
+        return _write_batcher
+
+
+def shutdown():
+    """
+    Flushes and closes the shared write batcher, if it was used.
+    """
+    global _write_batcher
+    with _write_batcher_lock:
+        write_batcher, _write_batcher = _write_batcher, None
+    if write_batcher is not None:
+        write_batcher.close()
@@ -0,0 +1,115 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+import atexit
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def use_temporary_environment(**overrides) -> str:
+    """
+    Points the app at a throwaway database and photo directories, removed on exit.
+
+    Must be called before the app is imported, since its modules read these at import.
+    """
+    directory = tempfile.mkdtemp(prefix="hairlyzer-bench-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ["PHOTO_STORE_DIR"] = os.path.join(directory, "photo_store")
+    os.environ["PHOTO_CACHE_DIR"] = os.path.join(directory, "photo_cache")
+    for name, value in overrides.items():
+        os.environ.setdefault(name, str(value))
+    return directory
+
+
+def summarize(samples_ms: Iterable[float]) -> dict:
+    samples = np.asarray(list(samples_ms), dtype=np.float64)
+    if not len(samples):
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "count": int(len(samples)),
+        "mean_ms": round(float(samples.mean()), 3),
+        "stdev_ms": round(float(samples.std(ddof=1)) if len(samples) > 1 else 0.0, 3),
+        "min_ms": round(float(samples.min()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(samples.max()), 3),
+    }
+
+
+def environment() -> dict:
+    return {
+        "recorded_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def environment_differences(recorded: Optional[dict], current: dict) -> List[str]:
+    """
+    Lists how the machine a baseline was recorded on differs from this one, ignoring when.
+    Baselines recorded without their environment are assumed to match.
+    """
+    if not recorded:
+        return []
+    return [
+        f"{key} {recorded.get(key)} vs {current.get(key)}"
+        for key in sorted(current)
+        if key != "recorded_at" and recorded.get(key) != current.get(key)
+    ]
+
+
+def load_json(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path: str, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def find_regressions(current: Dict[str, dict], baseline: Dict[str, dict], metric: str, threshold: float,
+                     min_delta: float, unit: str = "ms", noise_metric: Optional[str] = None) -> List[str]:
+    """
+    Lists the entries whose `metric` grew by more than `threshold` (a fraction) and by more
+    than `min_delta` over the baseline, so noise never fails a run. With `noise_metric`, the
+    growth must also exceed twice the larger spread of the two runs.
+    """
+    regressions = []
+    for name, before in sorted(baseline.items()):
+        after = current.get(name)
+        if after is None or metric not in before or metric not in after:
+            continue
+        old, new = before[metric], after[metric]
+        required = min_delta
+        if noise_metric is not None:
+            required = max(required, 2 * max(before.get(noise_metric, 0), after.get(noise_metric, 0)))
+        if new > old * (1 + threshold) and new - old > required:
+            growth = f"+{(new / old - 1) * 100:.0f}%" if old else "new"
+            regressions.append(f"{name}: {metric} {old:.2f}{unit} -> {new:.2f}{unit} ({growth})")
+    return regressions
+
+
+def report_regressions(regressions: List[str]) -> int:
+    """
+    Prints regressions and returns the process exit status for them.
+    """
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
@@ -0,0 +1,176 @@
+"""
+Load test that drives the app in-process with concurrent virtual users.
+
+Each user registers, logs in, then repeatedly submits an assessment (polling its analysis job
+until it completes), reads its profile and progress tracker, and loads the home page. Requests
+go through httpx's ASGI transport, so nothing listens on a socket and the run works offline.
+The transport waits for background tasks before returning, so /assessment/ latencies include
+the thumbnail pre-rendering.
+
+Latency percentiles and throughput are reported per route and written as JSON, then compared
+with the committed baseline; the run fails if a route's p95 latency grew past the threshold.
+Baselines are machine specific, so record one on the CI box with --update-baseline. A baseline
+recorded on another machine is not compared against, unless --ignore-environment.
+
+    python -m package.benchmarks.load --users 20 --iterations 5
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+from .common import (
+    BASELINE_DIR, environment, environment_differences, find_regressions, load_json, report_regressions, save_json, summarize,
+    use_temporary_environment,
+)
+
+# Cheap hashing, so the run measures the app rather than bcrypt's work factor
+use_temporary_environment(BCRYPT_ROUNDS=4)
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from ..main import app  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BASELINE_DIR, "load.json")
+JOB_POLL_INTERVAL = 0.02
+JOB_TIMEOUT = 60
+
+QUESTIONNAIRE = json.dumps({"answers": {"main_hair_concern": "Hair loss", "stress_level": "Very stressed", "diet": "Balanced"}})
+
+
+def _scalp_photo() -> bytes:
+    # Noise rather than a flat colour, so the JPEG is a realistic size
+    pixels = np.random.default_rng(0).integers(0, 256, size=(480, 640, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def request(self, client: httpx.AsyncClient, route: str, method: str, url: str,
+                      expected=(), **kwargs) -> httpx.Response:
+        """
+        Sends a request, recording its latency under `route`, the path template it hits. Error
+        statuses count as errors unless listed in `expected`.
+        """
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies[f"{method} {route}"].append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 400 and response.status_code not in expected:
+            self.errors[f"{method} {route}"] += 1
+        return response
+
+
+async def _virtual_user(client: httpx.AsyncClient, recorder: Recorder, number: int, iterations: int, photo: bytes):
+    email = f"load-{number}@example.com"
+    await recorder.request(client, "/register/", "POST", "/register/", json={
+        "username": email, "email": email, "password": "password", "name": f"Load User {number}",
+        "age_range": "18-40", "gender": "Female", "primary_hair_concern": "Hair loss",
+        "family_history_hair_loss": number % 2 == 0,
+    })
+    response = await recorder.request(client, "/login/", "POST", "/login/", data={"username": email, "password": "password"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    for _ in range(iterations):
+        submitted = time.perf_counter()
+        response = await recorder.request(
+            client, "/assessment/", "POST", "/assessment/", headers=headers,
+            data={"questionnaire_str": QUESTIONNAIRE}, files={"file": ("scalp.jpg", photo, "image/jpeg")},
+        )
+        job_id = response.json()["job_id"]
+        while True:
+            job = (await recorder.request(
+                client, "/assessment/jobs/{job_id}", "GET", f"/assessment/jobs/{job_id}", headers=headers,
+            )).json()
+            if job["status"] in ("completed", "failed") or time.perf_counter() - submitted > JOB_TIMEOUT:
+                break
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+        # Time from upload to a stored assessment, as a client sees it
+        recorder.latencies["job assessment analysis"].append((time.perf_counter() - submitted) * 1000)
+        if job["status"] != "completed":
+            recorder.errors["job assessment analysis"] += 1
+
+        await recorder.request(client, "/profile/", "GET", "/profile/", headers=headers)
+        # 404 until the user has two assessments
+        await recorder.request(client, "/progress-tracker/", "GET", "/progress-tracker/", headers=headers, expected=(404,))
+        await recorder.request(client, "/home", "GET", "/home")
+
+
+async def run(users: int, iterations: int) -> dict:
+    recorder = Recorder()
+    photo = _scalp_photo()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=JOB_TIMEOUT) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(_virtual_user(client, recorder, number, iterations, photo) for number in range(users)))
+            elapsed = time.perf_counter() - started
+
+    routes = {}
+    for route, samples in sorted(recorder.latencies.items()):
+        routes[route] = dict(summarize(samples), errors=recorder.errors[route], rps=round(len(samples) / elapsed, 2))
+    requests = sum(len(samples) for route, samples in recorder.latencies.items() if not route.startswith("job "))
+    return {
+        "environment": environment(),
+        "config": {"users": users, "iterations": iterations},
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": requests,
+        "rps": round(requests / elapsed, 2),
+        "routes": routes,
+    }
+
+
+def _print_results(results: dict):
+    print(f"{results['config']['users']} users x {results['config']['iterations']} iterations: "
+          f"{results['requests']} requests in {results['elapsed_seconds']}s, {results['rps']} req/s", file=sys.stderr)
+    print(f"{'route':<36}{'count':>7}{'errors':>7}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}", file=sys.stderr)
+    for route, stats in results["routes"].items():
+        print(f"{route:<36}{stats['count']:>7}{stats['errors']:>7}{stats['rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the app in-process and compare with a baseline.")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=5, help="assessment rounds per user")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="replace the baseline with these results")
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed p95 growth, as a fraction of the baseline")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="ignore p95 growth smaller than this")
+    parser.add_argument("--ignore-environment", action="store_true", help="compare even with a baseline from another machine")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.users, args.iterations))
+    _print_results(results)
+    if args.output:
+        save_json(args.output, results)
+    if args.update_baseline:
+        save_json(args.baseline, results)
+        return 0
+
+    failures = [f"{route}: {stats['errors']} errors" for route, stats in results["routes"].items() if stats["errors"]]
+    if os.path.exists(args.baseline):
+        baseline = load_json(args.baseline)
+        differences = environment_differences(baseline.get("environment"), results["environment"])
+        if baseline["config"] != results["config"]:
+            print(f"Baseline was recorded with {baseline['config']}, not comparing", file=sys.stderr)
+        elif differences and not args.ignore_environment:
+            print(f"Baseline was recorded on another machine ({'; '.join(differences)}), not comparing", file=sys.stderr)
+        else:
+            failures += find_regressions(results["routes"], baseline["routes"], "p95_ms", args.threshold, args.min_delta_ms)
+    return report_regressions(failures)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
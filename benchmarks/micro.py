@@ -0,0 +1,299 @@
+"""
+Microbenchmarks of the functions that run on every request or every write.
+
+Each benchmark is warmed up, then timed over `--samples` samples of enough calls to last at
+least MIN_SAMPLE_SECONDS, with the garbage collector paused as timeit does. Results are
+summarized per call (median, interquartile range, mean, standard deviation, min), appended to
+a history file with the commit they were measured at, and compared with the committed
+baseline. A benchmark regresses when its median grew past the threshold by more than twice
+the larger interquartile range of the two runs. Timings only compare on the same machine, so
+a baseline recorded elsewhere is reported but not gated on unless --ignore-environment.
+
+    python -m package.benchmarks.micro
+    python -m package.benchmarks.micro --filter report --samples 30
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator
+
+import numpy as np
+
+from .common import (
+    BASELINE_DIR, environment, environment_differences, find_regressions, load_json, report_regressions, save_json,
+    use_temporary_environment,
+)
+
+use_temporary_environment(BCRYPT_ROUNDS=4)
+
+from .. import auth, cache, crud, reports, schemas, serialization  # noqa: E402
+from ..main import ProfileResponse, SessionLocal, _generate_test_report, _profile_response, get_current_user, initialize  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BASELINE_DIR, "micro.json")
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history", "micro.jsonl")
+MIN_SAMPLE_SECONDS = 0.02
+WARMUP_SECONDS = 0.1
+PROFILE_ASSESSMENTS = 500
+
+EMAIL = "micro@example.com"
+QUESTIONNAIRE = {"answers": {"main_hair_concern": "Hair loss", "stress_level": "Very stressed", "diet": "Balanced"}}
+
+BENCHMARKS: Dict[str, Callable[[], Iterator[Callable[[], object]]]] = {}
+
+
+def benchmark(name: str):
+    """
+    Registers a setup generator, which prepares its state, yields the call to time and then
+    releases whatever it holds.
+    """
+    def register(setup):
+        BENCHMARKS[name] = contextmanager(setup)
+        return setup
+    return register
+
+
+def _user():
+    with SessionLocal() as db:
+        user = crud.get_user_by_email(db, email=EMAIL)
+        if user is None:
+            user = crud.create_user(db, user=schemas.UserCreate(
+                username=EMAIL, email=EMAIL, password="password", name="Micro User", age_range="18-40",
+                gender="Female", primary_hair_concern="Hair loss", family_history_hair_loss=True,
+            ))
+        db.expunge(user)
+        return user
+
+
+def _token() -> str:
+    return auth.create_access_token(data={"sub": EMAIL}, expires_delta=None)
+
+
+@benchmark("auth.create_access_token")
+def _create_access_token():
+    yield _token
+
+
+@benchmark("get_current_user, cached principal")
+def _current_user_cached():
+    _user()
+    token = _token()
+
+    def call():
+        with SessionLocal() as db:
+            return get_current_user(db, token)
+    yield call
+
+
+@benchmark("get_current_user, JWT decode and lookup")
+def _current_user_uncached():
+    _user()
+    token = _token()
+
+    def call():
+        cache.principal_cache.pop(token)
+        with SessionLocal() as db:
+            return get_current_user(db, token)
+    yield call
+
+
+@benchmark("crud.get_user_by_email")
+def _get_user_by_email():
+    _user()
+    with SessionLocal() as db:
+        def call():
+            user = crud.get_user_by_email(db, email=EMAIL)
+            # So every call queries rather than returning the instance already loaded
+            db.expunge(user)
+            return user
+        yield call
+
+
+@benchmark("crud.create_assessment")
+def _create_assessment():
+    user = _user()
+    assessment = schemas.AssessmentCreate(
+        questionnaire=QUESTIONNAIRE,
+        scalp_photo_url="/scalp_photos/micro.jpg",
+        analysis_results=reports.generate_report(QUESTIONNAIRE, seed=0),
+        timestamp="2025-01-01T10:00:00",
+    )
+
+    def call():
+        with SessionLocal() as db:
+            return crud.create_assessment(db, assessment=assessment, user_id=user.id)
+    yield call
+
+
+@benchmark("_generate_test_report")
+def _test_report():
+    seeds = iter(range(1 << 62))
+    yield lambda: _generate_test_report(QUESTIONNAIRE, seed=next(seeds))
+
+
+def _profile_payload():
+    """
+    Stores PROFILE_ASSESSMENTS assessments for a separate user, once, and returns them as /profile/ does.
+    """
+    email = "micro-profile@example.com"
+    with SessionLocal() as db:
+        user = crud.get_user_by_email(db, email=email)
+        if user is None:
+            user = crud.create_user(db, user=schemas.UserCreate(
+                username=email, email=email, password="password", name="Profile User", age_range="18-40",
+                gender="Female", primary_hair_concern="Hair loss", family_history_hair_loss=True,
+            ))
+            for i in range(PROFILE_ASSESSMENTS):
+                results = reports.generate_report(QUESTIONNAIRE, seed=i)
+                results["scalp_analysis"] = {"hair_density": "Medium", "redness": "Low", "flakes": "Some", "oiliness": "Normal"}
+                crud.add_assessment(db, schemas.AssessmentCreate(
+                    questionnaire=QUESTIONNAIRE,
+                    scalp_photo_url=f"/scalp_photos/{i:064x}.jpg",
+                    analysis_results=results,
+                    timestamp=f"2025-01-01T10:{i // 60:02d}:{i % 60:02d}",
+                ), user_id=user.id)
+            db.commit()
+        rows = crud.get_assessments_page(db, user_id=user.id, limit=PROFILE_ASSESSMENTS)
+        summary = crud.get_user_summary(db, user_id=user.id)
+        assessments = [serialization.assessment_dict(row) for row in rows]
+        db.expunge_all()
+    return user, summary, assessments
+
+
+@benchmark(f"ProfileResponse, {PROFILE_ASSESSMENTS} assessments")
+def _profile_model():
+    user, summary, assessments = _profile_payload()
+    payload = {
+        "name": user.name, "email": user.email, "profile_photo_url": user.profile_photo_url,
+        "assessments_count": summary.assessments_count, "last_assessment_date": summary.latest_timestamp,
+        "assessments": assessments, "next_cursor": None, "current_hair_health_score": summary.latest_score,
+    }
+    yield lambda: ProfileResponse.model_validate(payload).model_dump_json()
+
+
+@benchmark(f"_profile_response, {PROFILE_ASSESSMENTS} assessments")
+def _profile_fast():
+    user, summary, assessments = _profile_payload()
+    yield lambda: _profile_response(user, summary, assessments, None, current_hair_health_score=summary.latest_score)
+
+
+def _loops_per_sample(call: Callable) -> int:
+    # Doubles the loop count until one sample lasts long enough to time reliably
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            call()
+        if time.perf_counter() - started >= MIN_SAMPLE_SECONDS:
+            return loops
+        loops *= 2
+
+
+def measure(call: Callable, samples: int) -> dict:
+    deadline = time.perf_counter() + WARMUP_SECONDS
+    while time.perf_counter() < deadline:
+        call()
+    loops = _loops_per_sample(call)
+    timings = np.empty(samples)
+    gc_was_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        for i in range(samples):
+            started = time.perf_counter_ns()
+            for _ in range(loops):
+                call()
+            timings[i] = (time.perf_counter_ns() - started) / loops / 1000
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    q1, median, q3 = np.percentile(timings, [25, 50, 75])
+    return {
+        "samples": samples,
+        "loops": loops,
+        "median_us": round(float(median), 3),
+        "iqr_us": round(float(q3 - q1), 3),
+        "mean_us": round(float(timings.mean()), 3),
+        "stdev_us": round(float(timings.std(ddof=1)), 3),
+        "min_us": round(float(timings.min()), 3),
+    }
+
+
+def run(samples: int, name_filter: str = "") -> dict:
+    initialize()
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if name_filter in name:
+            with setup() as call:
+                results[name] = measure(call, samples)
+    return {"environment": environment(), "commit": _commit(), "benchmarks": results}
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(path: str, results: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    entry = {
+        "recorded_at": results["environment"]["recorded_at"],
+        "commit": results["commit"],
+        "median_us": {name: stats["median_us"] for name, stats in results["benchmarks"].items()},
+    }
+    with open(path, "a") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+def _print_results(results: dict, baseline: dict):
+    print(f"{'benchmark':<48}{'median us':>12}{'iqr us':>10}{'stdev us':>10}{'baseline':>12}{'change':>9}", file=sys.stderr)
+    for name, stats in results["benchmarks"].items():
+        before = baseline.get(name, {}).get("median_us")
+        change = f"{(stats['median_us'] / before - 1) * 100:+.0f}%" if before else ""
+        print(f"{name:<48}{stats['median_us']:>12.2f}{stats['iqr_us']:>10.2f}{stats['stdev_us']:>10.2f}"
+              f"{before or float('nan'):>12.2f}{change:>9}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the microbenchmarks and compare them with a baseline.")
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="replace the baseline with these results")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON lines file the medians are appended to")
+    parser.add_argument("--no-history", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed median growth, as a fraction of the baseline")
+    parser.add_argument("--min-delta-us", type=float, default=1.0, help="ignore median growth smaller than this")
+    parser.add_argument("--ignore-environment", action="store_true", help="gate even on a baseline from another machine")
+    args = parser.parse_args(argv)
+
+    results = run(args.samples, args.filter)
+    stored = load_json(args.baseline) if os.path.exists(args.baseline) else {}
+    baseline = stored.get("benchmarks", {})
+    _print_results(results, baseline)
+    if args.output:
+        save_json(args.output, results)
+    if not args.no_history:
+        append_history(args.history, results)
+    if args.update_baseline:
+        save_json(args.baseline, dict(results, benchmarks=dict(baseline, **results["benchmarks"])))
+        return 0
+    differences = environment_differences(stored.get("environment"), results["environment"])
+    if differences and not args.ignore_environment:
+        print(f"Baseline was recorded on another machine ({'; '.join(differences)}), not gating", file=sys.stderr)
+        return 0
+    return report_regressions(find_regressions(
+        results["benchmarks"], baseline, "median_us", args.threshold, args.min_delta_us, unit="us", noise_metric="iqr_us",
+    ))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Compares serializing a 500-assessment profile through per-row pydantic models and the
+response_model validation FastAPI does, as /profile/ used to, with the serialization
+module's direct path.
+
+    python -m package.benchmarks.profile_serialization
+    python -m package.benchmarks.profile_serialization --assessments 50 --rounds 3
+
+Both paths must produce the same JSON, or the run fails before timing anything.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from .common import use_temporary_environment
+
+DEFAULT_ASSESSMENTS = 500
+DEFAULT_ROUNDS = 20
+
+use_temporary_environment()
+
+from fastapi.testclient import TestClient  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+from .. import crud, derivatives, reports, schemas, serialization  # noqa: E402
+from ..main import ProfileResponse, SessionLocal, _profile_response, app  # noqa: E402
+
+_profile_adapter = TypeAdapter(ProfileResponse)
+
+
+def _seed(client: TestClient, assessments: int) -> str:
+    email = "bench@example.com"
+    client.post("/register/", json={
+        "username": email, "email": email, "password": "password", "name": "Bench User",
+        "age_range": "18-40", "gender": "Female", "primary_hair_concern": "Hair loss",
+        "family_history_hair_loss": True,
+    })
+    questionnaire = {"answers": {"main_hair_concern": "Hair loss", "stress_level": "Very stressed", "diet": "Balanced"}}
+    with SessionLocal() as db:
+        user = crud.get_user_by_email(db, email=email)
+        for i in range(assessments):
+            results = reports.generate_report(questionnaire, seed=i)
+            results["scalp_analysis"] = {"hair_density": "Medium", "redness": "Low", "flakes": "Some", "oiliness": "Normal"}
+            crud.add_assessment(db, schemas.AssessmentCreate(
+                questionnaire=questionnaire,
+                scalp_photo_url=f"/scalp_photos/{i:064x}.jpg",
+                analysis_results=results,
+                timestamp=f"2025-01-01T10:{i // 60:02d}:{i % 60:02d}",
+            ), user_id=user.id)
+        db.commit()
+    token = client.post("/login/", data={"username": email, "password": "password"}).json()["access_token"]
+    return token
+
+
+def _assessment_model(row) -> schemas.Assessment:
+    # The variant URLs are not a column, so they are filled in before validating
+    fields = {name: getattr(row, name) for name in schemas.Assessment.model_fields if name != "scalp_photo_variants"}
+    return schemas.Assessment.model_validate(dict(fields, scalp_photo_variants=derivatives.variant_urls(row.scalp_photo_url)))
+
+
+def _legacy(user, summary, rows) -> bytes:
+    # Per-row models, then the response_model validation and serialization FastAPI does
+    profile = ProfileResponse(
+        name=user.name, email=user.email, profile_photo_url=user.profile_photo_url,
+        assessments_count=summary.assessments_count, last_assessment_date=summary.latest_timestamp,
+        assessments=[_assessment_model(row) for row in rows], next_cursor=None,
+        current_hair_health_score=summary.latest_score,
+    )
+    validated = _profile_adapter.validate_python(profile.model_dump())
+    return json.dumps(_profile_adapter.dump_python(validated, mode="json")).encode()
+
+
+def _fast(user, summary, rows) -> bytes:
+    assessments = [serialization.assessment_dict(row) for row in rows]
+    return _profile_response(user, summary, assessments, None, current_hair_health_score=summary.latest_score).body
+
+
+def _time(rounds: int, fn, *args) -> float:
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the pydantic and direct serialization of a profile.")
+    parser.add_argument("--assessments", type=int, default=DEFAULT_ASSESSMENTS)
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS)
+    args = parser.parse_args(argv)
+    with TestClient(app) as client:
+        return _run(client, args.assessments, args.rounds)
+
+
+def _run(client: TestClient, assessments: int, rounds: int) -> int:
+    token = _seed(client, assessments)
+    with SessionLocal() as db:
+        user = crud.get_user_by_email(db, email="bench@example.com")
+        summary = crud.get_user_summary(db, user_id=user.id)
+        rows = crud.get_assessments_page(db, user_id=user.id, limit=assessments)
+        if json.loads(_legacy(user, summary, rows)) != json.loads(_fast(user, summary, rows)):
+            print("The two serialization paths produced different payloads", file=sys.stderr)
+            return 1
+        legacy_ms, fast_ms = _time(rounds, _legacy, user, summary, rows), _time(rounds, _fast, user, summary, rows)
+
+    headers = {"Authorization": f"Bearer {token}"}
+    request_ms = _time(rounds, lambda: client.get(f"/profile/?limit={assessments}", headers=headers))
+    print(f"{assessments} assessments, median of {rounds} rounds", file=sys.stderr)
+    print(f"serialization, pydantic response_model:   {legacy_ms:8.2f} ms", file=sys.stderr)
+    print(f"serialization, direct dicts + orjson:    {fast_ms:8.2f} ms ({legacy_ms / fast_ms:.1f}x)", file=sys.stderr)
+    print(f"GET /profile/ end to end:                {request_ms:8.2f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Bulk NDJSON export and import of users and assessments.
+
+Exports read the table in id order one chunk at a time, so memory stays flat however large
+the table is. Imports insert each chunk with a single multi-row INSERT and commit it before
+reading on. Rows whose id already exists are skipped, so an interrupted import can be re-run
+from its checkpoint (or from the start) without duplicating rows.
+
+    python -m package.bulk export assessments assessments.ndjson
+    python -m package.bulk import assessments assessments.ndjson --checkpoint assessments.ckpt
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import select
+
+from . import database, models
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 5000))
+
+TABLES = {
+    "users": models.User.__table__,
+    "assessments": models.Assessment.__table__,
+}
+
+
+def get_table(name: str):
+    try:
+        return TABLES[name]
+    except KeyError:
+        raise ValueError(f"Unknown table {name!r}, expected one of {', '.join(TABLES)}")
+
+
+def export_rows(engine, table_name: str, chunk_size: int = BULK_CHUNK_SIZE, after_id: Optional[int] = None) -> Iterator[str]:
+    """
+    Yields the rows of a table as JSON objects, one per row, in id order.
+    """
+    table = get_table(table_name)
+    query = select(table).order_by(table.c.id).limit(chunk_size)
+    while True:
+        with engine.connect() as connection:
+            page = query if after_id is None else query.where(table.c.id > after_id)
+            rows = connection.execute(page).mappings().all()
+        for row in rows:
+            yield json.dumps(dict(row), separators=(",", ":"))
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1]["id"]
+
+
+class Importer:
+    """
+    Buffers NDJSON rows for one table and inserts them `chunk_size` at a time.
+    """
+
+    def __init__(self, engine, table_name: str, chunk_size: int = BULK_CHUNK_SIZE):
+        self.engine = engine
+        self.table = get_table(table_name)
+        self.chunk_size = chunk_size
+        self.columns = set(self.table.c.keys())
+        self.lines = 0
+        self.inserted = 0
+        self._rows = []
+
+    def feed(self, line) -> bool:
+        """
+        Adds one NDJSON line, returning True if it completed a chunk that was committed.
+        """
+        self.lines += 1
+        if not line.strip():
+            return False
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise ValueError(f"Line {self.lines} is not valid JSON")
+        if not isinstance(row, dict) or "id" not in row:
+            raise ValueError(f"Line {self.lines} is not a row with an id")
+        self._rows.append({key: value for key, value in row.items() if key in self.columns})
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        with self.engine.begin() as connection:
+            result = connection.execute(self.table.insert().prefix_with("OR IGNORE", dialect="sqlite"), rows)
+            self.inserted += max(result.rowcount, 0)
+            if self.table is models.Assessment.__table__:
+                # Summaries are rebuilt lazily by crud.get_user_summary
+                summaries = models.UserSummary.__table__
+                owner_ids = {row.get("owner_id") for row in rows}
+                connection.execute(summaries.delete().where(summaries.c.user_id.in_(owner_ids)))
+
+
+def _read_checkpoint(path: str, source: str) -> dict:
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return {"offset": 0, "lines": 0}
+    if checkpoint.get("source") != os.path.abspath(source):
+        raise ValueError(f"Checkpoint {path} belongs to {checkpoint.get('source')}")
+    return checkpoint
+
+
+def _write_checkpoint(path: str, source: str, offset: int, lines: int):
+    partial_path = path + ".part"
+    with open(partial_path, "w") as f:
+        json.dump({"source": os.path.abspath(source), "offset": offset, "lines": lines}, f)
+    os.replace(partial_path, path)
+
+
+def import_file(engine, table_name: str, path: str, checkpoint_path: Optional[str] = None,
+                chunk_size: int = BULK_CHUNK_SIZE, progress=None) -> Importer:
+    """
+    Imports an NDJSON file, recording the position of the last committed chunk in
+    `checkpoint_path` so an interrupted import resumes where it stopped.
+    """
+    checkpoint = _read_checkpoint(checkpoint_path, path) if checkpoint_path else {"offset": 0, "lines": 0}
+    importer = Importer(engine, table_name, chunk_size=chunk_size)
+    importer.lines = checkpoint["lines"]
+    with open(path, "rb") as f:
+        f.seek(checkpoint["offset"])
+        # readline instead of iteration, which would hide the file position behind read-ahead
+        for line in iter(f.readline, b""):
+            if importer.feed(line):
+                if checkpoint_path:
+                    _write_checkpoint(checkpoint_path, path, f.tell(), importer.lines)
+                if progress:
+                    progress(importer)
+        importer.flush()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return importer
+
+
+def write_lines(lines: Iterable[str], out):
+    for line in lines:
+        out.write(line)
+        out.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import users and assessments as NDJSON.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("table", choices=TABLES)
+    export_parser.add_argument("path", nargs="?", default="-", help="output file, - for stdout")
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("table", choices=TABLES)
+    import_parser.add_argument("path")
+    import_parser.add_argument("--checkpoint", help="file recording progress, to resume an interrupted import")
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument("--chunk-size", type=int, default=BULK_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    models.ensure_schema(database.engine)
+    started = time.monotonic()
+    if args.command == "export":
+        lines = export_rows(database.read_engine, args.table, chunk_size=args.chunk_size)
+        if args.path == "-":
+            write_lines(lines, sys.stdout)
+        else:
+            with open(args.path, "w") as out:
+                write_lines(lines, out)
+        return
+
+    def progress(importer):
+        elapsed = time.monotonic() - started
+        print(f"{importer.lines} lines, {importer.inserted} inserted, {importer.inserted / elapsed:.0f} rows/s", file=sys.stderr)
+
+    importer = import_file(database.engine, args.table, args.path, checkpoint_path=args.checkpoint,
+                           chunk_size=args.chunk_size, progress=progress)
+    print(f"Imported {importer.inserted} of {importer.lines} lines in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
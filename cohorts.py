@@ -0,0 +1,187 @@
+"""
+Score distributions by user cohort.
+
+refresh() aggregates assessment scores in SQL, grouped by each profile field in
+COHORT_DIMENSIONS, and stores one models.CohortStats row per cohort with its histogram and
+percentiles. Readers only ever read those rows. They are refreshed at startup and on read when
+the newest stored refresh is older than COHORT_REFRESH_INTERVAL, on a background thread so
+readers get the previous results meanwhile. Staleness is read from the table rather than kept
+per process, so workers sharing the database do not each refresh it.
+"""
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import Boolean, case, func, select
+
+from . import models
+
+COHORT_BUCKET_WIDTH = 5
+COHORT_MAX_SCORE = 100
+COHORT_PERCENTILES = (10, 25, 50, 75, 90)
+COHORT_REFRESH_INTERVAL = float(os.getenv("COHORT_REFRESH_INTERVAL", 300))
+
+COHORT_DIMENSIONS = {
+    "age_range": models.User.age_range,
+    "gender": models.User.gender,
+    "primary_hair_concern": models.User.primary_hair_concern,
+    "family_history_hair_loss": models.User.family_history_hair_loss,
+}
+
+_BUCKETS = COHORT_MAX_SCORE // COHORT_BUCKET_WIDTH + 1
+_stats = models.CohortStats.__table__
+
+
+def _cohort(column):
+    """
+    The cohort of a user as text, computed in SQL so users without a value share the cohort of
+    users who chose "unknown" instead of producing a second row with the same name.
+    """
+    if isinstance(column.type, Boolean):
+        return case((column.is_(None), "unknown"), (column, "yes"), else_="no")
+    return func.coalesce(column, "unknown")
+
+
+def percentiles_from_histogram(counts: Sequence[int], width: int, percentiles: Sequence[float],
+                               low: Optional[float] = None, high: Optional[float] = None) -> Dict[str, Optional[float]]:
+    """
+    Estimates percentiles from bucket counts, assuming scores are spread evenly within a bucket
+    and clamping to the known `low` and `high` scores.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return {f"p{p:g}": None for p in percentiles}
+    cumulative = np.cumsum(counts)
+    # Never below the smallest positive rank, so p0 lands in the first non-empty bucket
+    ranks = np.maximum(np.asarray(percentiles, dtype=np.float64) / 100 * total, np.finfo(np.float64).tiny)
+    buckets = np.minimum(np.searchsorted(cumulative, ranks, side="left"), len(counts) - 1)
+    before = cumulative[buckets] - counts[buckets]
+    within = np.divide(ranks - before, counts[buckets], out=np.zeros_like(ranks), where=counts[buckets] > 0)
+    values = (buckets + within) * width
+    values = np.clip(values, low if low is not None else -np.inf, high if high is not None else np.inf)
+    return {f"p{p:g}": round(float(value), 2) for p, value in zip(percentiles, values)}
+
+
+def aggregate(connection, dimension: str) -> List[dict]:
+    """
+    Computes the score distribution of every cohort of a dimension with two grouped queries.
+    """
+    column = COHORT_DIMENSIONS[dimension]
+    score = models.Assessment.analysis_results["score"].as_integer()
+    scored = (
+        select(_cohort(column).label("cohort"), score.label("score"), models.Assessment.owner_id.label("owner_id"))
+        .join_from(models.Assessment, models.User, models.Assessment.owner_id == models.User.id)
+        .where(score.is_not(None))
+        .subquery()
+    )
+    totals = connection.execute(
+        select(
+            scored.c.cohort,
+            func.count(func.distinct(scored.c.owner_id)),
+            func.count(),
+            func.sum(scored.c.score),
+            func.min(scored.c.score),
+            func.max(scored.c.score),
+        ).group_by(scored.c.cohort)
+    ).all()
+    bucket = case(
+        (scored.c.score < 0, 0),
+        (scored.c.score >= COHORT_MAX_SCORE, _BUCKETS - 1),
+        else_=scored.c.score // COHORT_BUCKET_WIDTH,
+    )
+    histograms = {}
+    for cohort, index, count in connection.execute(
+        select(scored.c.cohort, bucket, func.count()).group_by(scored.c.cohort, bucket)
+    ):
+        histograms.setdefault(cohort, [0] * _BUCKETS)[int(index)] = count
+
+    rows = []
+    for cohort, users_count, scored_count, score_sum, min_score, max_score in totals:
+        histogram = histograms.get(cohort, [0] * _BUCKETS)
+        rows.append({
+            "dimension": dimension,
+            "cohort": cohort,
+            "users_count": users_count,
+            "scored_count": scored_count,
+            "score_sum": score_sum or 0,
+            "min_score": min_score,
+            "max_score": max_score,
+            "histogram": histogram,
+            "percentiles": percentiles_from_histogram(histogram, COHORT_BUCKET_WIDTH, COHORT_PERCENTILES, min_score, max_score),
+        })
+    return rows
+
+
+def refresh(engine):
+    """
+    Recomputes every cohort and replaces the stored results in one transaction.
+    """
+    refreshed_at = datetime.now().isoformat()
+    with engine.begin() as connection:
+        rows = [dict(row, refreshed_at=refreshed_at) for dimension in COHORT_DIMENSIONS for row in aggregate(connection, dimension)]
+        connection.execute(_stats.delete())
+        if rows:
+            connection.execute(_stats.insert(), rows)
+
+
+def is_stale(engine) -> bool:
+    """
+    Whether the stored cohorts are missing or were refreshed over COHORT_REFRESH_INTERVAL ago,
+    by any process.
+    """
+    with engine.connect() as connection:
+        refreshed_at = connection.execute(select(func.max(_stats.c.refreshed_at))).scalar()
+    if refreshed_at is None:
+        return True
+    return (datetime.now() - datetime.fromisoformat(refreshed_at)).total_seconds() > COHORT_REFRESH_INTERVAL
+
+
+_refresh_lock = threading.Lock()
+
+
+def refresh_in_background(engine):
+    """
+    Starts a refresh on a background thread, unless one is already running. The thread checks
+    again that the results are stale, as another worker may have just refreshed them.
+    """
+    if not _refresh_lock.acquire(blocking=False):
+        return  # Already refreshing
+
+    def run():
+        try:
+            if is_stale(engine):
+                refresh(engine)
+        finally:
+            _refresh_lock.release()
+
+    threading.Thread(target=run, name="cohort-refresh", daemon=True).start()
+
+
+def get_cohorts(read_engine, write_engine, dimension: str) -> List[dict]:
+    """
+    Returns the stored cohorts of a dimension, refreshing them in the background if they are
+    missing or older than COHORT_REFRESH_INTERVAL.
+    """
+    if is_stale(read_engine):
+        refresh_in_background(write_engine)
+    with read_engine.connect() as connection:
+        rows = connection.execute(
+            select(_stats).where(_stats.c.dimension == dimension).order_by(_stats.c.cohort)
+        ).mappings().all()
+    return [
+        {
+            "cohort": row["cohort"],
+            "users_count": row["users_count"],
+            "scored_count": row["scored_count"],
+            "mean_score": round(row["score_sum"] / row["scored_count"], 2) if row["scored_count"] else None,
+            "min_score": row["min_score"],
+            "max_score": row["max_score"],
+            "percentiles": row["percentiles"],
+            "histogram": {"bucket_width": COHORT_BUCKET_WIDTH, "counts": row["histogram"]},
+            "refreshed_at": row["refreshed_at"],
+        }
+        for row in rows
+    ]
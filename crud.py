@@ -1,12 +1,25 @@
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from . import models, schemas, auth
-from typing import List
+from typing import List, Optional, Tuple
+from datetime import datetime
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = auth.get_password_hash(user.password)
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: Optional[str] = None):
+    if hashed_password is None:
+        hashed_password = auth.get_password_hash(user.password)
+    db_user = add_user(db, user=user, hashed_password=hashed_password)
+    db.commit()
+    db.refresh(db_user)
+    return db_user
+
+def add_user(db: Session, user: schemas.UserCreate, hashed_password: str):
+    """
+    Adds and flushes a new user without committing, see batcher.WriteBatcher.
+    """
     db_user = models.User(
         email=user.email,
         hashed_password=hashed_password,
@@ -16,26 +29,232 @@ def create_user(db: Session, user: schemas.UserCreate):
         gender=user.gender,
         primary_hair_concern=user.primary_hair_concern,
         family_history_hair_loss=user.family_history_hair_loss,
+        assessments=[],
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
     return db_user
 
 def authenticate_user(db: Session, email: str, password: str):
     db_user = get_user_by_email(db, email=email)
     if not db_user:
         return None
-    if not auth.verify_password(password, db_user.hashed_password):
+    valid, new_hash = auth.verify_and_update_password(password, db_user.hashed_password)
+    if not valid:
         return None
+    if new_hash:
+        update_password_hash(db, db_user, new_hash)
+    return db_user
+
+def update_password_hash(db: Session, db_user: models.User, hashed_password: str):
+    db_user.hashed_password = hashed_password
+    db.commit()
     return db_user
 
 def create_assessment(db: Session, assessment: schemas.AssessmentCreate, user_id: int):
-    db_assessment = models.Assessment(**assessment.dict(), owner_id=user_id)
-    db.add(db_assessment)
+    db_assessment = add_assessment(db, assessment=assessment, user_id=user_id)
     db.commit()
     db.refresh(db_assessment)
     return db_assessment
 
+def add_assessment(db: Session, assessment: schemas.AssessmentCreate, user_id: int):
+    """
+    Adds and flushes a new assessment and updates the user's summary, without committing.
+    """
+    db_assessment = models.Assessment(**assessment.dict(), owner_id=user_id)
+    db.add(db_assessment)
+    db.flush()
+    _record_assessment(db, user_id, score=_score_of(db_assessment.analysis_results), timestamp=db_assessment.timestamp)
+    return db_assessment
+
+def _score_of(analysis_results) -> Optional[int]:
+    if isinstance(analysis_results, dict) and isinstance(analysis_results.get("score"), int):
+        return analysis_results["score"]
+    return None
+
+def _record_assessment(db: Session, user_id: int, score: Optional[int], timestamp: str):
+    """
+    Folds a newly flushed assessment into the user's summary row and last assessment date.
+    """
+    summary = models.UserSummary
+    is_latest = or_(summary.latest_timestamp.is_(None), summary.latest_timestamp <= timestamp)
+    values = {
+        summary.assessments_count: summary.assessments_count + 1,
+        summary.latest_timestamp: case((is_latest, timestamp), else_=summary.latest_timestamp),
+        summary.latest_score: case((is_latest, score), else_=summary.latest_score),
+    }
+    if score is not None:
+        values.update({
+            summary.scored_count: summary.scored_count + 1,
+            summary.score_sum: summary.score_sum + score,
+            summary.min_score: case((or_(summary.min_score.is_(None), summary.min_score > score), score), else_=summary.min_score),
+            summary.max_score: case((or_(summary.max_score.is_(None), summary.max_score < score), score), else_=summary.max_score),
+        })
+    # A single UPDATE keeps concurrent inserts for the same user from losing counts
+    updated = db.query(summary).filter(summary.user_id == user_id).update(values, synchronize_session=False)
+    if not updated:
+        # First assessment, or a user from before summaries existed
+        rebuild_user_summary(db, user_id)
+
+    db_user = db.get(models.User, user_id)
+    if db_user is not None and (db_user.last_assessment_date is None or db_user.last_assessment_date <= timestamp):
+        db_user.last_assessment_date = timestamp
+
+def rebuild_user_summary(db: Session, user_id: int) -> models.UserSummary:
+    """
+    Recomputes a user's summary row from their assessments. Does not commit.
+    """
+    score = models.Assessment.analysis_results["score"].as_integer()
+    count, scored_count, score_sum, min_score, max_score = (
+        db.query(func.count(models.Assessment.id), func.count(score), func.sum(score), func.min(score), func.max(score))
+        .filter(models.Assessment.owner_id == user_id)
+        .one()
+    )
+    latest = get_latest_assessments(db, user_id=user_id, limit=1)
+    values = {
+        "assessments_count": count,
+        "scored_count": scored_count,
+        "score_sum": score_sum or 0,
+        "min_score": min_score,
+        "max_score": max_score,
+        "latest_timestamp": latest[0].timestamp if latest else None,
+        "latest_score": _score_of(latest[0].analysis_results) if latest else None,
+    }
+    # An upsert, as another request may create the row between our read and write
+    db.execute(
+        sqlite_insert(models.UserSummary)
+        .values(user_id=user_id, **values)
+        .on_conflict_do_update(index_elements=[models.UserSummary.user_id], set_=values)
+    )
+    return db.get(models.UserSummary, user_id, populate_existing=True)
+
+def get_user_summary(db: Session, user_id: int) -> models.UserSummary:
+    """
+    Returns the user's summary row, building it first for users from before summaries existed.
+    """
+    db_summary = db.get(models.UserSummary, user_id)
+    if db_summary is None:
+        db_summary = rebuild_user_summary(db, user_id)
+        db.commit()
+    return db_summary
+
 def get_assessments_by_user(db: Session, user_id: int) -> List[models.Assessment]:
-    return db.query(models.Assessment).filter(models.Assessment.owner_id == user_id).all()
+    return (
+        db.query(models.Assessment)
+        .filter(models.Assessment.owner_id == user_id)
+        .order_by(models.Assessment.timestamp, models.Assessment.id)
+        .all()
+    )
+
+def get_latest_assessments(db: Session, user_id: int, limit: int) -> List[models.Assessment]:
+    """
+    Returns the user's `limit` most recent assessments, newest first.
+    """
+    return (
+        db.query(models.Assessment)
+        .filter(models.Assessment.owner_id == user_id)
+        .order_by(models.Assessment.timestamp.desc(), models.Assessment.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+def get_assessments_page(db: Session, user_id: int, limit: int, before: Optional[Tuple[str, int]] = None) -> List[models.Assessment]:
+    """
+    Returns up to `limit` of the user's assessments, newest first, that come after the
+    (timestamp, id) key `before` of the previous page.
+    """
+    query = db.query(models.Assessment).filter(models.Assessment.owner_id == user_id)
+    if before is not None:
+        timestamp, assessment_id = before
+        query = query.filter(
+            or_(
+                models.Assessment.timestamp < timestamp,
+                and_(models.Assessment.timestamp == timestamp, models.Assessment.id < assessment_id),
+            )
+        )
+    return query.order_by(models.Assessment.timestamp.desc(), models.Assessment.id.desc()).limit(limit).all()
+
+def get_users_page(db: Session, limit: int, after_id: Optional[int] = None) -> List[models.User]:
+    """
+    Returns up to `limit` users ordered by id, starting after `after_id`.
+    """
+    query = db.query(models.User)
+    if after_id is not None:
+        query = query.filter(models.User.id > after_id)
+    return query.order_by(models.User.id).limit(limit).all()
+
+def get_score_history(db: Session, user_id: int, after: Optional[Tuple[str, int]] = None) -> List[Tuple[str, int, Optional[int]]]:
+    """
+    Returns (timestamp, id, score) for the user's assessments, oldest first, that come after
+    the (timestamp, id) key `after`.
+    """
+    query = db.query(
+        models.Assessment.timestamp, models.Assessment.id, models.Assessment.analysis_results["score"].as_integer()
+    ).filter(models.Assessment.owner_id == user_id)
+    if after is not None:
+        timestamp, assessment_id = after
+        query = query.filter(
+            or_(
+                models.Assessment.timestamp > timestamp,
+                and_(models.Assessment.timestamp == timestamp, models.Assessment.id > assessment_id),
+            )
+        )
+    return [tuple(row) for row in query.order_by(models.Assessment.timestamp, models.Assessment.id).all()]
+
+def count_assessments(db: Session, user_id: int) -> int:
+    return db.query(func.count(models.Assessment.id)).filter(models.Assessment.owner_id == user_id).scalar()
+
+def get_latest_score(db: Session, user_id: int) -> Optional[int]:
+    return (
+        db.query(models.Assessment.analysis_results["score"].as_integer())
+        .filter(models.Assessment.owner_id == user_id)
+        .order_by(models.Assessment.timestamp.desc(), models.Assessment.id.desc())
+        .limit(1)
+        .scalar()
+    )
+
+def get_photo_blob(db: Session, sha256: str):
+    return db.get(models.PhotoBlob, sha256)
+
+def get_or_create_photo_blob(db: Session, sha256: str, path: str, size: int, content_type: Optional[str] = None):
+    db_blob = get_photo_blob(db, sha256)
+    if db_blob is None:
+        # INSERT OR IGNORE, as a concurrent upload of the same bytes may insert the row first
+        db.execute(
+            sqlite_insert(models.PhotoBlob)
+            .values(sha256=sha256, path=path, size=size, content_type=content_type, created_at=datetime.now().isoformat())
+            .on_conflict_do_nothing(index_elements=[models.PhotoBlob.sha256])
+        )
+        db_blob = get_photo_blob(db, sha256)
+    return db_blob
+
+def create_photo_reference(db: Session, blob_sha256: str, owner_id: int, kind: str, assessment_id: Optional[int] = None):
+    db_reference = (
+        db.query(models.PhotoReference)
+        .filter(
+            models.PhotoReference.blob_sha256 == blob_sha256,
+            models.PhotoReference.owner_id == owner_id,
+            models.PhotoReference.kind == kind,
+            models.PhotoReference.assessment_id == assessment_id,
+        )
+        .first()
+    )
+    if db_reference is None:
+        db_reference = models.PhotoReference(
+            blob_sha256=blob_sha256,
+            owner_id=owner_id,
+            kind=kind,
+            assessment_id=assessment_id,
+            created_at=datetime.now().isoformat(),
+        )
+        db.add(db_reference)
+        db.flush()
+    return db_reference
+
+def set_profile_photo(db: Session, user_id: int, blob_sha256: str, path: str, size: int, content_type: Optional[str], url: str):
+    get_or_create_photo_blob(db, sha256=blob_sha256, path=path, size=size, content_type=content_type)
+    create_photo_reference(db, blob_sha256=blob_sha256, owner_id=user_id, kind="profile")
+    db_user = db.get(models.User, user_id)
+    db_user.profile_photo_url = url
+    db.commit()
+    return db_user
@@ -0,0 +1,89 @@
+"""
+Async versions of the functions in crud.py.
+
+Each function runs its crud.py counterpart through `db.run_sync`, so with an AsyncSession the
+queries go through the async driver while the query logic stays in crud.py. `db` may also be a
+database.ThreadedSession, which runs the same functions in the threadpool.
+
+Lazy loading is not available on rows returned from an AsyncSession, so relationships that
+callers serialize are loaded before returning.
+"""
+from typing import List, Optional, Tuple
+from . import auth, crud, models, schemas
+
+
+def _with_assessments(fn):
+    def load(db, *args, **kwargs):
+        result = fn(db, *args, **kwargs)
+        if result is not None:
+            result.assessments
+        return result
+    return load
+
+async def get_user_by_email(db, email: str):
+    return await db.run_sync(crud.get_user_by_email, email=email)
+
+async def create_user(db, user: schemas.UserCreate, hashed_password: Optional[str] = None):
+    if hashed_password is None:
+        hashed_password = await auth.get_password_hash_async(user.password)
+    return await db.run_sync(_with_assessments(crud.create_user), user=user, hashed_password=hashed_password)
+
+async def authenticate_user(db, email: str, password: str):
+    db_user = await get_user_by_email(db, email=email)
+    if not db_user:
+        return None
+    valid, new_hash = await auth.verify_and_update_password_async(password, db_user.hashed_password)
+    if not valid:
+        return None
+    if new_hash:
+        # The hash was made with a different bcrypt cost than the configured one
+        await update_password_hash(db, db_user, new_hash)
+    return db_user
+
+async def update_password_hash(db, db_user: models.User, hashed_password: str):
+    return await db.run_sync(crud.update_password_hash, db_user, hashed_password)
+
+async def create_assessment(db, assessment: schemas.AssessmentCreate, user_id: int):
+    return await db.run_sync(crud.create_assessment, assessment=assessment, user_id=user_id)
+
+async def rebuild_user_summary(db, user_id: int) -> models.UserSummary:
+    return await db.run_sync(crud.rebuild_user_summary, user_id=user_id)
+
+async def get_user_summary(db, user_id: int) -> models.UserSummary:
+    return await db.run_sync(crud.get_user_summary, user_id=user_id)
+
+async def get_assessments_by_user(db, user_id: int) -> List[models.Assessment]:
+    return await db.run_sync(crud.get_assessments_by_user, user_id=user_id)
+
+async def get_latest_assessments(db, user_id: int, limit: int) -> List[models.Assessment]:
+    return await db.run_sync(crud.get_latest_assessments, user_id=user_id, limit=limit)
+
+async def get_assessments_page(db, user_id: int, limit: int, before: Optional[Tuple[str, int]] = None) -> List[models.Assessment]:
+    return await db.run_sync(crud.get_assessments_page, user_id=user_id, limit=limit, before=before)
+
+async def get_users_page(db, limit: int, after_id: Optional[int] = None) -> List[models.User]:
+    return await db.run_sync(crud.get_users_page, limit=limit, after_id=after_id)
+
+async def get_score_history(db, user_id: int, after: Optional[Tuple[str, int]] = None) -> List[Tuple[str, int, Optional[int]]]:
+    return await db.run_sync(crud.get_score_history, user_id=user_id, after=after)
+
+async def count_assessments(db, user_id: int) -> int:
+    return await db.run_sync(crud.count_assessments, user_id=user_id)
+
+async def get_latest_score(db, user_id: int) -> Optional[int]:
+    return await db.run_sync(crud.get_latest_score, user_id=user_id)
+
+async def get_photo_blob(db, sha256: str):
+    return await db.run_sync(crud.get_photo_blob, sha256=sha256)
+
+async def get_or_create_photo_blob(db, sha256: str, path: str, size: int, content_type: Optional[str] = None):
+    return await db.run_sync(crud.get_or_create_photo_blob, sha256=sha256, path=path, size=size, content_type=content_type)
+
+async def create_photo_reference(db, blob_sha256: str, owner_id: int, kind: str, assessment_id: Optional[int] = None):
+    return await db.run_sync(crud.create_photo_reference, blob_sha256=blob_sha256, owner_id=owner_id, kind=kind, assessment_id=assessment_id)
+
+async def set_profile_photo(db, user_id: int, blob_sha256: str, path: str, size: int, content_type: Optional[str], url: str):
+    return await db.run_sync(
+        crud.set_profile_photo,
+        user_id=user_id, blob_sha256=blob_sha256, path=path, size=size, content_type=content_type, url=url,
+    )
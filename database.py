@@ -1,18 +1,128 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from starlette.concurrency import run_in_threadpool
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./hairlyzer.db"
-TEST_SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./hairlyzer.db")
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Serve async handlers from an AsyncSession on the aiosqlite driver instead of a sync
+# session driven from the threadpool.
+USE_ASYNC_DB = os.getenv("USE_ASYNC_DB", "0") == "1"
+
+# SQLite tuning. WAL lets readers run concurrently with the single writer, and NORMAL
+# synchronous is durable in WAL mode except for the last transactions on power loss.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 64 * 1024))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 10))
+
+
+def sqlite_pragmas(read_only: bool = False):
+    pragmas = [
+        f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}",
+        f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    else:
+        # The journal mode is stored in the database file, so only writers need to set it
+        pragmas.insert(0, f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    return pragmas
+
+
+def install_sqlite_pragmas(engine, read_only: bool = False):
+    """
+    Applies the tuning pragmas to every new connection of `engine`.
+    """
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_sqlite_engine(url: str, read_only: bool = False, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW):
+    """
+    Creates a pooled engine whose SQLite connections are tuned on connect.
+
+    Read-only engines refuse writes (PRAGMA query_only), so a separate read pool never
+    holds the write lock and, in WAL mode, never waits for writers. Other databases get a
+    plain pooled engine, without the SQLite connect arguments and pragmas.
+    """
+    sqlite = make_url(url).get_backend_name() == "sqlite"
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000} if sqlite else {},
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+    )
+    if sqlite:
+        install_sqlite_pragmas(engine, read_only=read_only)
+    return engine
+
+
+# Creating an engine opens no connections; they are made on first use
+engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-test_engine = create_engine(
-    TEST_SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-TestSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
+read_engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL, read_only=True, pool_size=DB_READ_POOL_SIZE)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+Base = declarative_base()
+
+_async_session_factory = None
+
+
+def get_async_sessionmaker():
+    """
+    Returns the AsyncSession factory, creating the async engine on first use.
+
+    Imported lazily so deployments without aiosqlite/greenlet keep working in sync mode.
+    """
+    global _async_session_factory
+    if _async_session_factory is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+        if async_engine.dialect.name == "sqlite":
+            install_sqlite_pragmas(async_engine.sync_engine)
+        _async_session_factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    return _async_session_factory
+
+
+class ThreadedSession:
+    """
+    Wraps a sync Session in the part of the AsyncSession interface used by crud_async,
+    running every call in the threadpool. Lets async handlers use one code path whether
+    or not the async engine is enabled.
+    """
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
 
-Base = declarative_base()
\ No newline at end of file
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
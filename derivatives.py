@@ -0,0 +1,163 @@
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", "photo_cache")
+CACHE_MAX_BYTES = int(os.getenv("PHOTO_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# How often a writer re-scans the cache directory for files written by other workers
+CACHE_RESCAN_SECONDS = float(os.getenv("PHOTO_CACHE_RESCAN_SECONDS", 30))
+JPEG_QUALITY = 80
+
+# Bounding boxes of the resized variants served next to the original photos.
+VARIANTS = {
+    "thumbnail": (160, 160),
+    "medium": (640, 640),
+}
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def variant_urls(photo_url: Optional[str]) -> Dict[str, str]:
+    """
+    Returns the derivative URLs for a photo in the content-addressed store.
+
+    Photos stored before the store existed have no derivatives.
+    """
+    if not photo_url:
+        return {}
+    sha256 = os.path.splitext(os.path.basename(photo_url))[0]
+    if not _SHA256_RE.match(sha256):
+        return {}
+    return {variant: f"/photos/{sha256}/{variant}" for variant in VARIANTS}
+
+
+def render(source_path: str, variant: str) -> bytes:
+    """
+    Resizes a photo to fit the variant's bounding box and re-encodes it as JPEG.
+    """
+    size = VARIANTS[variant]
+    with Image.open(source_path) as image:
+        # Let the JPEG decoder downscale while decoding instead of decoding the full image.
+        image.draft("RGB", (size[0] * 2, size[1] * 2))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(size)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+class DerivativeCache:
+    """
+    Size-bounded LRU cache of rendered variants on disk.
+
+    Recency is tracked in memory and mirrored to file mtimes, so the LRU order survives
+    restarts and is shared by every process using the directory. The least recently used files
+    are deleted once the cache grows past `max_bytes`. Writers re-scan the directory at most
+    every `rescan_seconds`, so with several workers the bound holds for the shared directory,
+    give or take what the others wrote since the last scan. Files rendered by another worker
+    are picked up on read rather than rendered again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, rescan_seconds: float = CACHE_RESCAN_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_seconds = rescan_seconds
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".part"):
+                    continue  # Still being written
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Evicted by another worker meanwhile
+                files.append((stat.st_mtime, os.path.relpath(path, self.directory), stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        self._total_bytes = sum(self._entries.values())
+        self._loaded_at = time.monotonic()
+
+    def get(self, key: str) -> Optional[str]:
+        path = os.path.join(self.directory, key)
+        with self._lock:
+            if self._loaded_at is None:
+                self._load()
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+        try:
+            os.utime(path)
+            size = None if known else os.path.getsize(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+            return None
+        if size is not None:
+            # Rendered by another worker since the last scan
+            with self._lock:
+                self._total_bytes += size - self._entries.pop(key, 0)
+                self._entries[key] = size
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(partial_path, "wb") as f:
+            f.write(data)
+        os.replace(partial_path, path)
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.rescan_seconds:
+                self._load()
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_key))
+            except FileNotFoundError:
+                pass
+        return path
+
+
+cache = DerivativeCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+
+def get_or_create(sha256: str, source_path: str, variant: str) -> str:
+    """
+    Returns the path of a cached variant, rendering it first if it is not cached yet.
+    """
+    key = f"{variant}/{sha256[:2]}/{sha256}.jpg"
+    path = cache.get(key)
+    if path is None:
+        path = cache.put(key, render(source_path, variant))
+    return path
+
+
+def warm(sha256: str, source_path: str, variant: str = "thumbnail"):
+    """
+    Renders a variant ahead of time, ignoring files that are not decodable images.
+    """
+    try:
+        get_or_create(sha256, source_path, variant)
+    except (OSError, UnidentifiedImageError):
+        pass
@@ -0,0 +1,195 @@
+import functools
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", os.cpu_count() or 1))
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", 64))
+ANALYSIS_JOB_TIMEOUT = float(os.getenv("ANALYSIS_JOB_TIMEOUT", 60))
+ANALYSIS_START_METHOD = os.getenv("ANALYSIS_START_METHOD", "spawn")
+JOB_HISTORY_SIZE = 10000
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, owner_id: int):
+        self.id = uuid.uuid4().hex
+        self.owner_id = owner_id
+        self.status = "pending"
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    def to_dict(self):
+        status = self.status
+        if status == "pending" and self.future is not None and self.future.running():
+            status = "running"
+        return {
+            "job_id": self.id,
+            "status": status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    Runs CPU-heavy functions in a bounded process pool and tracks them as jobs.
+
+    At most `queue_size` jobs may be pending or running at once; further submissions
+    raise JobQueueFull. A caller with work to do before submitting, like storing an upload,
+    can reserve() a slot first and pass `reserved=True`, so it fails fast when the queue is
+    full. A job that does not finish within `timeout` seconds is marked
+    as failed and its result is discarded. When a job's function returns, `on_success`
+    is called with its return value on a completion thread and whatever it returns
+    becomes the job's result. If it returns a Future, the job completes with that future's
+    result instead, without holding the completion thread while it is pending.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float, start_method: str = "spawn"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.start_method = start_method
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._completion_executor = None
+
+    def _get_executors(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                )
+                self._completion_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="job-completion")
+            return self._executor, self._completion_executor
+
+    def _reset_executor(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def reserve(self):
+        """
+        Takes a queue slot for a job submitted later with `reserved=True`, or raises JobQueueFull.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+
+    def release(self):
+        """
+        Gives back a slot taken by reserve() for a job that will not be submitted.
+        """
+        self._slots.release()
+
+    def submit(self, owner_id: int, func: Callable, args: tuple, on_success: Callable[[Any], Any], reserved: bool = False) -> Job:
+        if not reserved:
+            self.reserve()
+        job = Job(owner_id)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > JOB_HISTORY_SIZE:
+                self._jobs.popitem(last=False)
+        try:
+            executor, completion_executor = self._get_executors()
+            try:
+                future = executor.submit(func, *args)
+            except BrokenProcessPool:
+                self._reset_executor(executor)
+                executor, completion_executor = self._get_executors()
+                future = executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            job.status = "failed"
+            raise
+
+        job.future = future
+        timer = threading.Timer(self.timeout, self._expire, (job, future))
+        timer.daemon = True
+        timer.start()
+
+        def done(future):
+            timer.cancel()
+            completion_executor.submit(self._complete, job, future, on_success)
+
+        future.add_done_callback(done)
+        return job
+
+    def _expire(self, job: Job, future):
+        future.cancel()
+        self._finish(job, "failed", error="Analysis timed out")
+
+    def _complete(self, job: Job, future, on_success):
+        release = True
+        try:
+            if future.cancelled() or job.status != "pending":
+                return
+            try:
+                result = on_success(future.result())
+            except Exception as exc:
+                self._finish(job, "failed", error=str(exc) or exc.__class__.__name__)
+                return
+            if isinstance(result, Future):
+                # The slot is released once the deferred result is in
+                release = False
+                result.add_done_callback(functools.partial(self._complete_deferred, job))
+            else:
+                self._finish(job, "completed", result=result)
+        finally:
+            if release:
+                self._slots.release()
+
+    def _complete_deferred(self, job: Job, result_future):
+        try:
+            try:
+                result = result_future.result()
+            except Exception as exc:
+                self._finish(job, "failed", error=str(exc) or exc.__class__.__name__)
+            else:
+                self._finish(job, "completed", result=result)
+        finally:
+            self._slots.release()
+
+    def _finish(self, job: Job, status: str, result=None, error=None):
+        with self._lock:
+            if job.status != "pending":
+                return
+            job.status = status
+            job.result = result
+            job.error = error
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, completion_executor = self._executor, self._completion_executor
+            self._executor = self._completion_executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+            completion_executor.shutdown(wait=wait)
+
+
+analysis_jobs = JobManager(
+    workers=ANALYSIS_WORKERS,
+    queue_size=ANALYSIS_QUEUE_SIZE,
+    timeout=ANALYSIS_JOB_TIMEOUT,
+    start_method=ANALYSIS_START_METHOD,
+)
@@ -1,32 +1,62 @@
-from fastapi import Depends, FastAPI, HTTPException, File, UploadFile, Form, APIRouter
+from fastapi import Depends, FastAPI, HTTPException, File, UploadFile, Form, APIRouter, BackgroundTasks, Request, Response, Query, Header, Path as FastAPIPath
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-from . import crud, models, schemas, auth
-from .database import SessionLocal, engine
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from . import crud, models, schemas, auth, storage, derivatives, analysis, uploads, jobs, cache, pagination
+from starlette.concurrency import run_in_threadpool
+from . import database, crud_async, batcher, bulk, reports, rescore, progress, cohorts, static_responses, serialization, metrics, profiling
+from .database import SessionLocal, ReadSessionLocal, engine
+import functools
 import os
-import shutil
-from typing import List, Optional
+import time
+from concurrent.futures import Future
+from typing import List, Literal, Optional, Union
 from datetime import datetime, timedelta
-import random
-import random
 from pydantic import BaseModel
 from jose import JWTError, jwt
 
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
+def initialize():
+    """
+    Prepares the database and photo directories. Run by the lifespan, and idempotent.
+    """
+    models.ensure_schema(engine)
+    os.makedirs(storage.STORE_DIR, exist_ok=True)
+    os.makedirs(derivatives.CACHE_DIR, exist_ok=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(initialize)
+    # So the first cohort analytics request does not wait for the aggregation, unless another
+    # worker refreshed them recently
+    if await run_in_threadpool(cohorts.is_stale, database.read_engine):
+        cohorts.refresh_in_background(engine)
+    yield
+    jobs.analysis_jobs.shutdown()
+    # After the jobs, whose completions may still be queueing writes
+    batcher.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(static_responses.NotModifiedMiddleware)
+if profiling.PROFILING_ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
+# Added last so it is outermost and also sees the 304s answered above
+app.add_middleware(metrics.MetricsMiddleware)
 router = APIRouter()
 
-# Create the 'profile_photos' directory if it doesn't exist
-if not os.path.exists("profile_photos"):
-    os.makedirs("profile_photos")
+@app.exception_handler(jobs.JobQueueFull)
+def job_queue_full_handler(request: Request, exc: jobs.JobQueueFull):
+    return JSONResponse(status_code=503, content={"detail": "Analysis queue is full, try again later"}, headers={"Retry-After": "5"})
 
-# Mount the 'profile_photos' directory to serve static files
-app.mount("/profile_photos", StaticFiles(directory="profile_photos"), name="profile_photos")
+@app.exception_handler(auth.PasswordHasherBusy)
+def password_hasher_busy_handler(request: Request, exc: auth.PasswordHasherBusy):
+    return JSONResponse(status_code=503, content={"detail": "Too many login attempts in progress, try again later"}, headers={"Retry-After": "1"})
 
-# Mount the 'scalp_photos' directory to serve static files
-app.mount("/scalp_photos", StaticFiles(directory="scalp_photos"), name="scalp_photos")
+# Serve photos from the content-addressed store. Photos uploaded before the
+# store existed are still served from their original directories.
+app.mount("/profile_photos", storage.PhotoStaticFiles(legacy_directory="profile_photos"), name="profile_photos")
+app.mount("/scalp_photos", storage.PhotoStaticFiles(legacy_directory="scalp_photos"), name="scalp_photos")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -38,7 +68,48 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    """
+    Session dependency for handlers that only read, served from the read-only pool.
+    """
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_db():
+    """
+    Session dependency for async handlers, used through crud_async.
+    """
+    if database.USE_ASYNC_DB:
+        async with database.get_async_sessionmaker()() as db:
+            yield db
+    else:
+        db = database.ThreadedSession(SessionLocal())
+        try:
+            yield db
+        finally:
+            await db.close()
+
+def _principal_snapshot(user: models.User) -> dict:
+    return {attr.key: getattr(user, attr.key) for attr in sa_inspect(models.User).column_attrs}
+
+def _attach_principal(db: Session, snapshot: dict) -> models.User:
+    """
+    Rebuilds a cached user as a persistent instance of `db` without querying the database.
+    """
+    user = models.User(**snapshot)
+    make_transient_to_detached(user)
+    db.add(user)
+    return user
+
 def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+    # Tokens in the cache already passed signature verification and resolved to a user
+    snapshot = cache.principal_cache.get(token)
+    if snapshot is not None:
+        return _attach_principal(db, snapshot)
+
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -54,8 +125,34 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
     user = crud.get_user_by_email(db, email=email)
     if user is None:
         raise credentials_exception
+    # Never keep a principal around for longer than its token is valid
+    ttl = cache.principal_cache.ttl
+    if payload.get("exp") is not None:
+        ttl = min(ttl, payload["exp"] - time.time())
+    cache.principal_cache.set(token, _principal_snapshot(user), ttl=ttl)
     return user
 
+def _invalidate_principals(user_ids):
+    if user_ids:
+        cache.principal_cache.remove_where(lambda snapshot: snapshot["id"] in user_ids)
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    # ORM changes only, see cache.PRINCIPAL_CACHE_TTL for what this does not cover
+    user_ids = {obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, models.User)}
+    if user_ids:
+        session.info.setdefault("changed_user_ids", set()).update(user_ids)
+        _invalidate_principals(user_ids)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    # Invalidate again once committed, in case a concurrent request cached the old row in between
+    _invalidate_principals(session.info.pop("changed_user_ids", None))
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_user_ids", None)
+
 # Models for the Home Page
 class HomeButton(BaseModel):
     text: str
@@ -89,6 +186,7 @@ class ProfileResponse(BaseModel):
     assessments_count: int
     last_assessment_date: Optional[str] = None
     assessments: List[schemas.Assessment]
+    next_cursor: Optional[str] = None
     current_hair_health_score: Optional[int] = None
 
 
@@ -127,8 +225,8 @@ class Token(BaseModel):
     token_type: str
 
 @router.post("/token", response_model=Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.authenticate_user(db, email=form_data.username, password=form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db=Depends(get_async_db)):
+    user = await crud_async.authenticate_user(db, email=form_data.username, password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -142,17 +240,14 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-@app.get("/home")
-def get_home_page():
-    """
-    Returns the data for the mobile app's home page.
-    """
-    
-    buttons = [
+# The home page is the same for every user, so it is serialized once
+HOME_PAGE = static_responses.register("/home", HomePageResponse(
+    greeting="Welcome to Hairlyzer!",
+    buttons=[
         HomeButton(text="Start New Assessment", style="primary", action="/assessment/new"),
         HomeButton(text="View Progress", style="secondary", action="/progress"),
-    ]
-    tips = [
+    ],
+    tips=[
         HairCareTip(
             icon="brush_icon",
             title="Gentle Brushing",
@@ -168,209 +263,254 @@ def get_home_page():
             title="Condition Well",
             description="Apply conditioner to the ends of your hair.",
         ),
-    ]
-    navigation = [
+    ],
+    navigation=[
         NavItem(name="Home", icon="home_icon", is_active=True),
         NavItem(name="Assessment", icon="assessment_icon", is_active=False),
         NavItem(name="Progress", icon="progress_icon", is_active=False),
         NavItem(name="Profile", icon="profile_icon", is_active=False),
-    ]
-    return {"message": "Welcome to Hairlyzer!"}
+    ],
+).dict())
+
+@app.get("/home", response_model=HomePageResponse)
+def get_home_page():
+    """
+    Returns the data for the mobile app's home page.
+    """
+    return HOME_PAGE.response()
 
 @router.post("/register/", response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: schemas.UserCreate, db=Depends(get_async_db)):
     """
     Registers a new user with profile information.
     """
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = await crud_async.get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    created_user = crud.create_user(db=db, user=user)
+    if batcher.WRITE_BATCHING:
+        hashed_password = await auth.get_password_hash_async(user.password)
+        return await batcher.get_write_batcher().write_async(crud.add_user, user=user, hashed_password=hashed_password)
+    created_user = await crud_async.create_user(db, user=user)
     return created_user
 
 @router.post("/upload-profile-photo/")
-async def upload_profile_photo(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def upload_profile_photo(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user), db=Depends(get_async_db)):
     """
     Uploads a profile photo for a user.
     """
-    file_path = f"profile_photos/{current_user.email}_{file.filename}"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    url_path = f"/{file_path}"
-    current_user.profile_photo_url = url_path
-    db.commit()
+    blob = await storage.store_upload(file)
+    url_path = storage.photo_url("profile_photos", blob)
+    await crud_async.set_profile_photo(
+        db,
+        user_id=current_user.id,
+        blob_sha256=blob.sha256,
+        path=blob.path,
+        size=blob.size,
+        content_type=blob.content_type,
+        url=url_path,
+    )
     return {"message": "Profile photo uploaded successfully", "file_path": url_path}
 
+def _decode_cursor(cursor: str, types: tuple) -> list:
+    try:
+        return pagination.decode_cursor(cursor, types)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _assessments_page(db: Session, user_id: int, limit: int, before=None):
+    """
+    Returns a page of assessments, newest first, and the cursor of the next page if there may be one.
+    """
+    assessments = crud.get_assessments_page(db, user_id=user_id, limit=limit, before=before)
+    next_cursor = None
+    if len(assessments) == limit:
+        next_cursor = pagination.encode_cursor([assessments[-1].timestamp, assessments[-1].id])
+    return [serialization.assessment_dict(assessment) for assessment in assessments], next_cursor
+
+def _profile_response(user: models.User, summary: models.UserSummary, assessments: List[dict], next_cursor: Optional[str],
+                      current_hair_health_score: Optional[int] = None) -> serialization.FastJSONResponse:
+    """
+    Serializes a ProfileResponse directly, since its assessments are already plain dicts.
+    """
+    return serialization.FastJSONResponse({
+        "name": user.name,
+        "email": user.email,
+        "profile_photo_url": user.profile_photo_url,
+        "assessments_count": summary.assessments_count,
+        "last_assessment_date": summary.latest_timestamp,
+        "assessments": assessments,
+        "next_cursor": next_cursor,
+        "current_hair_health_score": current_hair_health_score,
+    })
+
 @router.get("/profile/", response_model=ProfileResponse)
-def get_profile(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """
-    Returns the user's profile information.
-    """
-    assessments = crud.get_assessments_by_user(db, user_id=current_user.id)
-    assessments_count = len(assessments)
-    last_assessment_date = current_user.last_assessment_date
-    current_hair_health_score = None
-    if assessments:
-        latest_assessment = assessments[-1]
-        if latest_assessment.analysis_results and isinstance(latest_assessment.analysis_results, dict):
-            current_hair_health_score = latest_assessment.analysis_results.get("score")
-
-    return ProfileResponse(
-        name=current_user.name,
-        email=current_user.email,
-        profile_photo_url=current_user.profile_photo_url,
-        assessments_count=assessments_count,
-        last_assessment_date=last_assessment_date,
-        assessments=assessments,
-        current_hair_health_score=current_hair_health_score,
-    )
+def get_profile(
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Returns the user's profile information with the most recent assessments.
 
-@router.post("/assessment/")
+    Older assessments are fetched by passing `next_cursor` back as `cursor`.
+    """
+    before = _decode_cursor(cursor, (str, int)) if cursor else None
+    assessments, next_cursor = _assessments_page(db, current_user.id, limit, before)
+    summary = crud.get_user_summary(db, user_id=current_user.id)
+    return _profile_response(current_user, summary, assessments, next_cursor, current_hair_health_score=summary.latest_score)
+
+@router.post("/assessment/", status_code=202)
 async def create_assessment(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     questionnaire_str: str = Form(...),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
 ):
     """
     Creates a new assessment, including a scalp photo and questionnaire.
-    """
-    # Save the scalp photo
-    file_path = f"scalp_photos/{current_user.email}_{file.filename}"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    scalp_photo_url = f"/{file_path}"
 
+    The photo is analyzed in the background; poll /assessment/jobs/{job_id} for the result.
+    """
     # Parse the questionnaire
     import json
     questionnaire = json.loads(questionnaire_str)
 
-    # Perform the analysis
-    analysis_results = _generate_test_report(questionnaire)
+    # Before storing the photo, so a full queue leaves no unreferenced blob behind
+    jobs.analysis_jobs.reserve()
+    try:
+        # Save the scalp photo
+        blob = await storage.store_upload(file)
+    except BaseException:
+        jobs.analysis_jobs.release()
+        raise
+    photo_path = os.path.join(storage.STORE_DIR, blob.path)
+
+    job = jobs.analysis_jobs.submit(
+        owner_id=current_user.id,
+        func=analysis.analyze_file,
+        args=(photo_path,),
+        on_success=functools.partial(_save_assessment, current_user.id, questionnaire, blob),
+        reserved=True,
+    )
+    # Pre-render the thumbnail used by the profile's assessment list
+    background_tasks.add_task(derivatives.warm, blob.sha256, photo_path)
+    return {"message": "Assessment submitted successfully", "job_id": job.id, "status": job.status}
+
+@router.get("/assessment/jobs/{job_id}")
+def get_assessment_job(job_id: str, current_user: models.User = Depends(get_current_user)):
+    """
+    Returns the status of an assessment analysis job, and its result once completed.
+    """
+    job = jobs.analysis_jobs.get(job_id)
+    if job is None or job.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+def _save_assessment(user_id: int, questionnaire: dict, blob: storage.StoredBlob, scalp_analysis: Optional[dict]) -> Union[dict, Future]:
+    """
+    Persists an assessment once its photo analysis has finished.
+
+    With write batching, returns a future of the result rather than waiting for the batch to
+    commit, so the few job completion threads can feed many writes into one batch.
+    """
+    seed = reports.new_seed()
+    analysis_results = _generate_test_report(questionnaire, seed=seed).dict()
+    analysis_results["report_seed"] = seed
+    if scalp_analysis is not None:
+        analysis_results["scalp_analysis"] = scalp_analysis
 
-    # Create the assessment
     assessment = schemas.AssessmentCreate(
         questionnaire=questionnaire,
-        scalp_photo_url=scalp_photo_url,
-        analysis_results=analysis_results.dict(),
+        scalp_photo_url=storage.photo_url("scalp_photos", blob),
+        analysis_results=analysis_results,
         timestamp=datetime.now().isoformat(),
+        rules_version=reports.RULES_VERSION,
     )
-    crud.create_assessment(db=db, assessment=assessment, user_id=current_user.id)
-
-    return {"message": "Assessment created successfully", "analysis": analysis_results}
-
 
+    def insert(db: Session) -> dict:
+        return {"assessment_id": _insert_assessment(db, user_id, assessment, blob), "analysis": analysis_results}
 
+    if batcher.WRITE_BATCHING:
+        return batcher.get_write_batcher().submit(insert)
+    db = SessionLocal()
+    try:
+        result = insert(db)
+        db.commit()
+    finally:
+        db.close()
+    return result
 
+def _insert_assessment(db: Session, user_id: int, assessment: schemas.AssessmentCreate, blob: storage.StoredBlob) -> int:
+    db_assessment = crud.add_assessment(db, assessment=assessment, user_id=user_id)
+    crud.get_or_create_photo_blob(db, sha256=blob.sha256, path=blob.path, size=blob.size, content_type=blob.content_type)
+    crud.create_photo_reference(db, blob_sha256=blob.sha256, owner_id=user_id, kind="scalp", assessment_id=db_assessment.id)
+    return db_assessment.id
 
-def _generate_test_report(questionnaire: dict) -> TestReport:
+def _generate_test_report(questionnaire: dict, seed: Optional[int] = None) -> TestReport:
     """
     Generates a test report based on the questionnaire with added randomization.
+
+    Reports made with the same seed and reports.RULES_VERSION are identical.
     """
-    answers = questionnaire.get("answers", {})
-    
-    # --- Dynamic Score ---
-    score = random.randint(30, 80)
-
-    # --- Expanded Key Findings Pool ---
-    possible_key_findings = [
-        "Noticeable thinning in the crown area.",
-        "The scalp appears to be in good condition, with no visible irritation.",
-        "Some dryness and flakiness is visible on the scalp.",
-        "Hair appears to be well-hydrated and has good elasticity.",
-        "A moderate amount of dandruff flakes were observed across the scalp.",
-        "No significant inflammation or redness was detected.",
-        "Hair follicles appear open and are not clogged.",
-        "The hair seems brittle and prone to breakage.",
-        "Scalp oiliness is within a normal range."
-    ]
-    key_findings = random.sample(possible_key_findings, k=random.randint(2, 4))
-
-    # Add specific findings based on answers
-    if answers.get('scalp_condition') == "Itchy or flaky":
-        key_findings.append("The scalp is reported as Itchy or flaky, which may be a contributing factor to hair health.")
-    if answers.get('stress_level') in ["Very stressed", "Moderately stressed"]:
-        key_findings.append(f"Reported stress level is {answers.get('stress_level')}, which can impact hair health.")
-
-    # --- Dynamic Diagnosis ---
-    diagnosis = "General hair health analysis."
-    if answers.get("family_hair_loss_history") == "Yes":
-        diagnosis = "Potential for Androgenetic Alopecia based on family history."
-    elif "hair loss" in answers.get("main_hair_concern", "").lower():
-        diagnosis = "Telogen Effluvium (stress-related shedding) is a possibility based on your concerns."
-
-    # --- Expanded Recommendations Pool ---
-    possible_recommendations = [
-        "Ensure a diet rich in iron, zinc, and B-vitamins to support hair growth.",
-        "Incorporate regular scalp massages to improve blood circulation to the follicles.",
-        "Avoid harsh chemical treatments and excessive heat styling for a few weeks.",
-        "Switch to a gentle, sulfate-free shampoo to avoid stripping natural oils.",
-        "Consider using a silk or satin pillowcase to reduce hair friction and breakage overnight.",
-        "Stay hydrated by drinking an adequate amount of water throughout the day.",
-        "Look into mindfulness or meditation to help manage stress levels.",
-        "A weekly deep conditioning treatment could improve hair moisture."
-    ]
-    recommendations = random.sample(possible_recommendations, k=random.randint(2, 3))
-
-    # Add specific recommendations based on answers
-    if "hair loss" in answers.get("main_hair_concern", "").lower():
-        recommendations.append("For hair loss concerns, consider a topical minoxidil treatment after consulting a specialist.")
-    if answers.get("diet") == "Poor (skips meals, low nutrients)":
-        recommendations.append("Your diet may be impacting your hair. Consulting a nutritionist for a personalized plan is highly recommended.")
-
-    # --- Determine Severity based on Score ---
-    severity = "Mild"
-    if score < 50:
-        severity = "Severe"
-    elif score < 70:
-        severity = "Moderate"
-
-    return TestReport(
-        severity=severity,
-        key_findings=list(set(key_findings)),  # Ensure unique findings
-        diagnosis=diagnosis,
-        recommendations=list(set(recommendations)), # Ensure unique recommendations
-        score=score,
-    )
+    return TestReport(**reports.generate_report(questionnaire, seed=seed))
 
 
 
+@router.get("/photos/{sha256}/{variant}")
+def get_photo_variant(sha256: str, variant: str, db: Session = Depends(get_read_db)):
+    """
+    Returns a resized variant (thumbnail, medium) of a stored photo.
+    """
+    blob = crud.get_photo_blob(db, sha256=sha256)
+    if variant not in derivatives.VARIANTS or blob is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    try:
+        path = derivatives.get_or_create(blob.sha256, os.path.join(storage.STORE_DIR, blob.path), variant)
+    except OSError:
+        raise HTTPException(status_code=415, detail="Photo cannot be resized")
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": storage.CACHE_CONTROL})
+
 @router.post("/analyze-scalp/")
 async def analyze_scalp(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    return {"message": "Scalp analysis completed successfully", "analysis": {}}
+    """
+    Analyzes a scalp photo and returns hair density, redness, dandruff and oiliness levels.
+    """
+    image_bytes = await uploads.read_upload(file)
+    try:
+        result = await run_in_threadpool(analysis.analyze_image, image_bytes)
+    except OSError:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+    return {"message": "Scalp analysis completed successfully", "analysis": ScalpAnalysisResult(**result)}
 
 @router.get("/holistic-report/")
-def get_holistic_report(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email=current_user.email)
-    if not user or not user.assessments:
+def get_holistic_report(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    if not crud.count_assessments(db, user_id=current_user.id):
         raise HTTPException(status_code=400, detail="Questionnaire or scalp analysis not completed")
     return {"summary": "summary", "recommendations": []}
 
 @router.get("/test-report/")
-def get_test_report(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email=current_user.email)
-    if not user or not user.assessments:
+def get_test_report(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    if not crud.count_assessments(db, user_id=current_user.id):
         raise HTTPException(status_code=400, detail="Questionnaire or scalp analysis not completed")
     return {"report_id": "report_id", "severity": "severity", "key_findings": [], "diagnosis": "diagnosis", "recommendations": []}
 
 @router.get("/progress-tracker/")
 def get_progress_tracker(current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email=current_user.email)
-    if not user or len(user.assessments) < 2:
+    """
+    Returns the trend of the user's scores over their whole assessment history.
+    """
+    trend = _score_trend(db, current_user.id)
+    if trend.n < 2:
         raise HTTPException(status_code=404, detail="Not enough data to track progress. Complete at least two assessments.")
-
-    # Get the last two assessments
-    latest_assessment = user.assessments[-1]
-    previous_assessment = user.assessments[-2]
-
-    latest_score = latest_assessment.analysis_results.get("score", 0)
-    previous_score = previous_assessment.analysis_results.get("score", 0)
+    (latest_timestamp, latest_score), (previous_timestamp, previous_score) = trend.latest, trend.previous
 
     progress_status = "none"
     suggestions = []
 
-    if latest_score > previous_score:
+    # The fitted slope, so a single noisy assessment does not flip the status
+    change = trend.slope if trend.slope is not None else latest_score - previous_score
+    if change > 0:
         progress_status = "good"
         suggestions.append("Your hair health is showing improvement! Keep up with your current routine.")
         suggestions.append("Consistency is key. Continue to follow the recommendations from your last report.")
@@ -381,30 +521,47 @@ def get_progress_tracker(current_user: models.User = Depends(get_current_user),
         suggestions.append("Consider consulting a dermatologist for a more in-depth analysis.")
 
     return {
-        "latest_assessment": {"score": latest_score, "timestamp": latest_assessment.timestamp},
-        "previous_assessment": {"score": previous_score, "timestamp": previous_assessment.timestamp},
+        "latest_assessment": {"score": latest_score, "timestamp": latest_timestamp},
+        "previous_assessment": {"score": previous_score, "timestamp": previous_timestamp},
         "progress_status": progress_status,
         "suggestions": suggestions,
+        "trend": trend.to_dict(),
     }
 
+def _score_trend(db: Session, user_id: int) -> progress.TrendState:
+    """
+    Returns the user's cached score trend, extended with the assessments added since it was cached.
+    """
+    summary = crud.get_user_summary(db, user_id=user_id)
+    expected = (summary.assessments_count, summary.score_sum)
+    trend = cache.trend_cache.get(user_id)
+    if trend is not None and (trend.count, trend.score_sum) != expected:
+        if summary.assessments_count > trend.count:
+            trend = trend.extend(crud.get_score_history(db, user_id=user_id, after=trend.last_key))
+        if (trend.count, trend.score_sum) != expected:
+            # An assessment older than the cached ones was added, or scores were changed
+            trend = None
+    if trend is None:
+        trend = progress.TrendState.from_history(crud.get_score_history(db, user_id=user_id))
+    cache.trend_cache.set(user_id, trend)
+    return trend
+
 @router.get("/profile/{email}")
-def get_profile(email: str, current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_profile(
+    email: str,
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
     user = crud.get_user_by_email(db, email=email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    assessments = crud.get_assessments_by_user(db, user_id=user.id)
-    assessments_count = len(assessments)
-    last_assessment_date = user.last_assessment_date
-
-    return ProfileResponse(
-        name=user.name,
-        email=user.email,
-        profile_photo_url=user.profile_photo_url,
-        assessments_count=assessments_count,
-        last_assessment_date=last_assessment_date,
-        assessments=assessments,
-    )
+    before = _decode_cursor(cursor, (str, int)) if cursor else None
+    assessments, next_cursor = _assessments_page(db, user.id, limit, before)
+    summary = crud.get_user_summary(db, user_id=user.id)
+    return _profile_response(user, summary, assessments, next_cursor)
 
 @router.get("/settings/{email}")
 def get_settings(email: str, current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
@@ -439,24 +596,182 @@ def get_account_security(current_user: models.User = Depends(get_current_user)):
     """
     return {"message": f"Account security for {current_user.email}"}
 
+HELP_SUPPORT = static_responses.register(
+    "/help-support/",
+    {"message": "For help and support, please visit our website or contact us at support@hairilyzer.com"},
+)
+
 @router.get("/help-support/")
 def get_help_support():
     """
     Returns help and support information (placeholder).
     """
-    return {"message": "For help and support, please visit our website or contact us at support@hairilyzer.com"}
-
-@router.get("/users/", response_model=List[schemas.User])
-def get_users(db: Session = Depends(get_db)):
+    return HELP_SUPPORT.response()
+
+@router.get("/users/", response_model=List[schemas.UserListItem])
+def get_users(
+    response: Response,
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json",
+    db: Session = Depends(get_read_db),
+):
     """
-    Returns a list of all registered users (for debugging purposes).
+    Returns a page of registered users (for debugging purposes).
+
+    The cursor for the next page is returned in the X-Next-Cursor header. With
+    format=ndjson, all users after the cursor are streamed one per line instead.
     """
-    users = db.query(models.User).all()
+    after_id = _decode_cursor(cursor, (int,))[0] if cursor else None
+    if format == "ndjson":
+        return StreamingResponse(pagination.ndjson_lines(_stream_users(after_id)), media_type=pagination.NDJSON_MEDIA_TYPE)
+    users = crud.get_users_page(db, limit=limit, after_id=after_id)
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor([users[-1].id])
     return users
 
+def _stream_users(after_id: Optional[int]):
+    db = ReadSessionLocal()
+    try:
+        while True:
+            users = crud.get_users_page(db, limit=pagination.STREAM_CHUNK_SIZE, after_id=after_id)
+            for user in users:
+                yield schemas.UserListItem.from_orm(user).json()
+            if len(users) < pagination.STREAM_CHUNK_SIZE:
+                return
+            after_id = users[-1].id
+            # Drop the rows already sent so memory stays flat
+            db.expunge_all()
+    finally:
+        db.close()
+
+@router.get("/assessments/", response_model=List[schemas.Assessment])
+def get_assessments(
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json",
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_read_db),
+):
+    """
+    Returns the user's assessment history, newest first, one page at a time.
+
+    The cursor for the next page is returned in the X-Next-Cursor header. With
+    format=ndjson, all assessments after the cursor are streamed one per line instead.
+    """
+    before = _decode_cursor(cursor, (str, int)) if cursor else None
+    if format == "ndjson":
+        return StreamingResponse(
+            pagination.ndjson_lines(_stream_assessments(current_user.id, before)),
+            media_type=pagination.NDJSON_MEDIA_TYPE,
+        )
+    assessments, next_cursor = _assessments_page(db, current_user.id, limit, before)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return serialization.FastJSONResponse(assessments, headers=headers)
+
+def _stream_assessments(user_id: int, before):
+    db = ReadSessionLocal()
+    try:
+        while True:
+            assessments = crud.get_assessments_page(db, user_id=user_id, limit=pagination.STREAM_CHUNK_SIZE, before=before)
+            for assessment in assessments:
+                yield serialization.dumps(serialization.assessment_dict(assessment))
+            if len(assessments) < pagination.STREAM_CHUNK_SIZE:
+                return
+            before = (assessments[-1].timestamp, assessments[-1].id)
+            db.expunge_all()
+    finally:
+        db.close()
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not auth.is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@router.get("/admin/export/{table}", dependencies=[Depends(require_admin)])
+def export_table(table: Literal["users", "assessments"], after_id: Optional[int] = None):
+    """
+    Streams every row of a table as NDJSON, in id order, starting after `after_id`.
+    """
+    return StreamingResponse(
+        pagination.ndjson_lines(bulk.export_rows(database.read_engine, table, after_id=after_id)),
+        media_type=pagination.NDJSON_MEDIA_TYPE,
+    )
+
+@router.post("/admin/import/{table}", dependencies=[Depends(require_admin)])
+async def import_table(table: Literal["users", "assessments"], request: Request):
+    """
+    Imports NDJSON rows from the request body, as exported by /admin/export/{table}.
+
+    Rows are committed in chunks and rows whose id already exists are skipped, so a failed
+    import can be retried with the same body.
+    """
+    importer = bulk.Importer(engine, table)
+    buffer = b""
+    try:
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            if lines:
+                await run_in_threadpool(_feed_lines, importer, lines)
+        if buffer:
+            await run_in_threadpool(_feed_lines, importer, [buffer])
+        await run_in_threadpool(importer.flush)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc}, {importer.inserted} rows were imported before it")
+    return {"lines": importer.lines, "inserted": importer.inserted}
+
+def _feed_lines(importer: bulk.Importer, lines: List[bytes]):
+    for line in lines:
+        importer.feed(line)
+
+@router.post("/admin/rescore", status_code=202, dependencies=[Depends(require_admin)])
+def start_rescore():
+    """
+    Starts re-scoring assessments made with older report rules, unless a run is in progress.
+    """
+    return rescore.start_background(engine).to_dict()
+
+@router.get("/admin/rescore", dependencies=[Depends(require_admin)])
+def get_rescore_progress():
+    progress = rescore.background_progress()
+    if progress is None:
+        raise HTTPException(status_code=404, detail="No rescore has been started")
+    return progress.to_dict()
+
+@router.get("/analytics/cohorts/{dimension}", dependencies=[Depends(require_admin)])
+def get_cohort_analytics(dimension: Literal["age_range", "gender", "primary_hair_concern", "family_history_hair_loss"]):
+    """
+    Returns the score distribution of each cohort of users sharing a value of `dimension`.
+
+    Results are precomputed and refreshed every cohorts.COHORT_REFRESH_INTERVAL seconds.
+    """
+    return {"dimension": dimension, "cohorts": cohorts.get_cohorts(database.read_engine, engine, dimension)}
+
+@router.post("/admin/cohorts/refresh", dependencies=[Depends(require_admin)])
+def refresh_cohort_analytics():
+    cohorts.refresh(engine)
+    return {"message": "Cohort analytics refreshed"}
+
+@router.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def get_request_profiles():
+    """
+    Lists the saved request profiles, newest first, with their route, user and timings.
+    """
+    return profiling.list_profiles()
+
+@router.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_request_profile(profile_id: str = FastAPIPath(..., pattern=r"^[0-9a-z-]+$")):
+    """
+    Returns a request profile as folded stacks, for flamegraph.pl or speedscope.
+    """
+    path = profiling.folded_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain")
+
 @router.post("/login/", response_model=Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.authenticate_user(db, email=form_data.username, password=form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db=Depends(get_async_db)):
+    user = await crud_async.authenticate_user(db, email=form_data.username, password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -469,6 +784,13 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(require_admin)])
+def get_metrics():
+    """
+    Returns request, query and timer metrics in the Prometheus text format.
+    """
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/")
 def get_status():
     """
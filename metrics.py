@@ -0,0 +1,294 @@
+"""
+Request, query and timer metrics, exposed in the Prometheus text format.
+
+MetricsMiddleware records every request against its route template, so cardinality stays
+bounded by the number of routes. With METRICS_ENABLED, SQL statements are timed by engine
+events on every engine, and added both to global totals and to the request that ran them, which makes N+1 patterns
+show up as a high db_queries_per_request for a route. The per-request totals live in a
+context variable, which the threadpool copies into sync handlers and dependencies.
+
+Metrics are plain dicts updated under a lock per metric and only formatted when /metrics is
+scraped, so the middleware adds around ten microseconds to a request. /metrics requires the
+admin token, as route names and traffic are not for anonymous callers.
+"""
+import bisect
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+BYTES_BUCKETS = (1024, 16 * 1024, 128 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in values]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, labels: Tuple[str, ...] = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        # Counts per bucket, made cumulative when rendered; the last slot is +Inf
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, labels: Tuple[str, ...] = ()) -> int:
+        state = self._values.get(labels)
+        return sum(state[0]) if state else 0
+
+    def sum(self, labels: Tuple[str, ...] = ()) -> float:
+        state = self._values.get(labels)
+        return state[1] if state else 0.0
+
+    @contextmanager
+    def time(self, labels: Tuple[str, ...] = ()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = self._header()
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render() -> bytes:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode()
+
+
+http_requests = _register(Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status")))
+http_request_duration = _register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency, until the response is sent.", ("method", "route"),
+))
+http_requests_in_flight = _register(Gauge("http_requests_in_flight", "HTTP requests being handled."))
+http_request_body_bytes = _register(Histogram(
+    "http_request_body_bytes", "Size of request bodies, uploads included.", ("method", "route"), buckets=BYTES_BUCKETS,
+))
+db_queries = _register(Counter("db_queries_total", "SQL statements executed."))
+db_query_duration = _register(Histogram("db_query_duration_seconds", "SQL statement latency.", buckets=QUERY_BUCKETS))
+db_queries_per_request = _register(Histogram(
+    "db_queries_per_request", "SQL statements run while handling one request.", ("route",), buckets=QUERY_COUNT_BUCKETS,
+))
+db_time_per_request = _register(Histogram(
+    "db_time_per_request_seconds", "Time spent in SQL statements while handling one request.", ("route",), buckets=QUERY_BUCKETS + (2.5, 5.0),
+))
+password_hash_duration = _register(Histogram(
+    "password_hash_duration_seconds", "bcrypt time by operation.", ("operation",),
+))
+report_generation_duration = _register(Histogram(
+    "report_generation_duration_seconds", "Time to generate a batch of test reports.",
+))
+reports_generated = _register(Counter("reports_generated_total", "Test reports generated."))
+
+
+class RequestQueries:
+    """
+    Statement totals of a request. Trackers started inside another one also add to the outer one.
+    """
+    __slots__ = ("count", "seconds", "parent")
+
+    def __init__(self, parent: Optional["RequestQueries"] = None):
+        self.count = 0
+        self.seconds = 0.0
+        self.parent = parent
+
+
+_request_queries: contextvars.ContextVar[Optional[RequestQueries]] = contextvars.ContextVar("request_queries", default=None)
+
+
+@contextmanager
+def track_queries():
+    """
+    Totals the SQL statements run in this context, threadpool calls made from it included.
+    """
+    queries = RequestQueries(_request_queries.get())
+    token = _request_queries.set(queries)
+    try:
+        yield queries
+    finally:
+        _request_queries.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    db_queries.inc()
+    db_query_duration.observe(elapsed)
+    queries = _request_queries.get()
+    while queries is not None:
+        queries.count += 1
+        queries.seconds += elapsed
+        queries = queries.parent
+
+
+def install_query_listeners():
+    """
+    Times SQL statements on every engine from now on. Idempotent.
+    """
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+if METRICS_ENABLED:
+    install_query_listeners()
+
+
+def route_name(scope) -> str:
+    """
+    The path template of the route that handled the request, so metrics are per route, not per URL.
+    """
+    return getattr(scope.get("route"), "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        responded = None
+        status = 500
+        body_bytes = 0
+        queries = RequestQueries(_request_queries.get())
+        token = _request_queries.set(queries)
+        http_requests_in_flight.inc()
+
+        async def counting_receive():
+            nonlocal body_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                body_bytes += len(message.get("body", b""))
+            return message
+
+        async def recording_send(message):
+            nonlocal status, responded
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                # Latency as the client sees it, before any background tasks run
+                responded = time.perf_counter()
+
+        try:
+            await self.app(scope, counting_receive, recording_send)
+        finally:
+            _request_queries.reset(token)
+            http_requests_in_flight.dec()
+            route = route_name(scope)
+            http_request_duration.observe((responded or time.perf_counter()) - started, (scope["method"], route))
+            http_requests.inc((scope["method"], route, str(status)))
+            if body_bytes:
+                http_request_body_bytes.observe(body_bytes, (scope["method"], route))
+            db_queries_per_request.observe(queries.count, (route,))
+            db_time_per_request.observe(queries.seconds, (route,))
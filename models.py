@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, JSON, ForeignKey
+from sqlalchemy import Boolean, Column, Integer, String, JSON, ForeignKey, Index, inspect
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -20,6 +20,10 @@ class User(Base):
 
 class Assessment(Base):
     __tablename__ = "assessments"
+    __table_args__ = (
+        # Serves "latest assessments of a user" lookups without sorting the user's history
+        Index("ix_assessments_owner_timestamp", "owner_id", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
@@ -27,5 +31,108 @@ class Assessment(Base):
     scalp_photo_url = Column(String)
     analysis_results = Column(JSON)
     timestamp = Column(String)
+    # reports.RULES_VERSION the analysis results were scored with, NULL for rows from before versions
+    rules_version = Column(Integer, nullable=True)
 
     owner = relationship("User", back_populates="assessments")
+
+class PhotoBlob(Base):
+    __tablename__ = "photo_blobs"
+
+    sha256 = Column(String, primary_key=True)
+    path = Column(String)
+    size = Column(Integer)
+    content_type = Column(String, nullable=True)
+    created_at = Column(String)
+
+class PhotoReference(Base):
+    __tablename__ = "photo_references"
+
+    id = Column(Integer, primary_key=True, index=True)
+    blob_sha256 = Column(String, ForeignKey("photo_blobs.sha256"), index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    assessment_id = Column(Integer, ForeignKey("assessments.id"), nullable=True)
+    kind = Column(String)  # 'profile' or 'scalp'
+    created_at = Column(String)
+
+    blob = relationship("PhotoBlob")
+
+class UserSummary(Base):
+    """
+    Per-user assessment statistics, maintained by crud.create_assessment in the same
+    transaction as the assessment insert.
+    """
+    __tablename__ = "user_summaries"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    assessments_count = Column(Integer, nullable=False, default=0)
+    latest_timestamp = Column(String, nullable=True)
+    latest_score = Column(Integer, nullable=True)
+    scored_count = Column(Integer, nullable=False, default=0)
+    score_sum = Column(Integer, nullable=False, default=0)
+    min_score = Column(Integer, nullable=True)
+    max_score = Column(Integer, nullable=True)
+
+    @property
+    def mean_score(self):
+        return self.score_sum / self.scored_count if self.scored_count else None
+
+class CohortStats(Base):
+    """
+    Score distribution of the users sharing a value of one profile field, materialized by
+    cohorts.refresh.
+    """
+    __tablename__ = "cohort_stats"
+
+    dimension = Column(String, primary_key=True)
+    cohort = Column(String, primary_key=True)
+    users_count = Column(Integer, nullable=False, default=0)
+    scored_count = Column(Integer, nullable=False, default=0)
+    score_sum = Column(Integer, nullable=False, default=0)
+    min_score = Column(Integer, nullable=True)
+    max_score = Column(Integer, nullable=True)
+    # Counts of scores per cohorts.COHORT_BUCKET_WIDTH wide bucket, starting at 0
+    histogram = Column(JSON)
+    percentiles = Column(JSON)
+    refreshed_at = Column(String)
+
+# Bump whenever a table, column or index is added, so existing databases are migrated
+SCHEMA_VERSION = 1
+
+def ensure_schema(bind):
+    """
+    Creates missing tables, columns and indexes unless the SQLite database is already at
+    SCHEMA_VERSION, which is checked with a single PRAGMA.
+    """
+    is_sqlite = bind.dialect.name == "sqlite"
+    if is_sqlite:
+        with bind.connect() as connection:
+            if connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+                return
+    Base.metadata.create_all(bind=bind)
+    add_missing_columns(bind)
+    create_missing_indexes(bind)
+    if is_sqlite:
+        with bind.begin() as connection:
+            connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def create_missing_indexes(bind):
+    """
+    Creates indexes declared on tables that already existed, which create_all skips.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+def add_missing_columns(bind):
+    """
+    Adds nullable columns declared on tables that already existed, which create_all skips.
+    """
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=bind.dialect)
+                with bind.begin() as connection:
+                    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
@@ -0,0 +1,38 @@
+import base64
+import json
+from typing import Iterable, Iterator, List, Sequence, Union
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_CHUNK_SIZE = 500
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def encode_cursor(values: List) -> str:
+    """
+    Encodes the sort key of the last row of a page into an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, types: Sequence[type]) -> List:
+    """
+    Decodes a cursor made by encode_cursor whose values have the given types, raising
+    ValueError if it is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    for value, expected in zip(values, types):
+        # bool is an int subclass, but never part of a sort key
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise ValueError("Invalid cursor")
+    return values
+
+
+def ndjson_lines(rows: Iterable[Union[str, bytes]]) -> Iterator[bytes]:
+    for row in rows:
+        yield (row if isinstance(row, bytes) else row.encode()) + b"\n"
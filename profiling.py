@@ -0,0 +1,211 @@
+"""
+On-demand profiling of single requests.
+
+With PROFILING_ENABLED=1, ProfilingMiddleware profiles requests that send an `X-Profile`
+header together with a valid `X-Admin-Token`, a PROFILE_SAMPLE_RATE fraction of them. While
+such a request runs, a thread samples the stacks of the event loop and the threadpool workers
+every PROFILE_INTERVAL_MS, so the handler, its dependencies, database calls and serialization
+are all covered wherever they run. Idle threads are skipped, but other requests running at
+the same time can show up too, so profiles are clearest on a quiet instance.
+
+Each profile is saved in PROFILE_DIR as folded stacks (`<id>.folded`, the input format of
+flamegraph.pl and speedscope) next to `<id>.json` with the route, user and timings. The
+response carries the id in `X-Profile-Id`. When profiling is disabled the middleware is not
+installed, so other requests pay nothing.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from jose import JWTError, jwt
+from starlette.concurrency import run_in_threadpool
+
+from . import auth, metrics
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 1.0))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 1.0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Innermost frames of threads waiting for work rather than doing any
+_IDLE_FILES = ("threading.py", "selectors.py", "queue.py")
+_WORKER_THREAD_PREFIX = "AnyIO worker thread"
+
+
+def _frame_label(code, labels: Dict[object, str]) -> str:
+    label = labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        # Shortest form of the path, relative to the entry of sys.path it was imported from
+        for entry in sorted((p or os.getcwd() for p in sys.path), key=len, reverse=True):
+            if filename.startswith(entry.rstrip(os.sep) + os.sep):
+                filename = filename[len(entry.rstrip(os.sep)) + 1:]
+                break
+        # Semicolons separate frames in the folded format
+        label = labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+    return label
+
+
+class StackSampler:
+    """
+    Counts the stacks of the event loop thread and the threadpool workers until stopped.
+    """
+
+    def __init__(self, loop_thread_id: int, interval: float):
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                name = names.get(thread_id, "")
+                if thread_id != self.loop_thread_id and not name.startswith(_WORKER_THREAD_PREFIX):
+                    continue
+                if frame.f_code.co_filename.endswith(_IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code, self._labels))
+                    frame = frame.f_back
+                thread_label = "event loop" if thread_id == self.loop_thread_id else "threadpool"
+                stack.append(thread_label)
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def _requested(scope) -> bool:
+    profile = admin_token = None
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            profile = value
+        elif name == b"x-admin-token":
+            admin_token = value.decode("latin-1")
+    return profile is not None and auth.is_admin_token(admin_token) and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _user(scope) -> Optional[str]:
+    # The caller's token, verified the same way get_current_user does
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer":
+                return None
+            try:
+                return jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM]).get("sub")
+            except JWTError:
+                return None
+    return None
+
+
+def _write(path: str, text: str):
+    # Written aside and renamed, so readers never see a partial file
+    partial_path = f"{path}.{uuid.uuid4().hex}.part"
+    with open(partial_path, "w") as f:
+        f.write(text)
+    os.replace(partial_path, path)
+
+
+def save(profile_id: str, sampler: StackSampler, metadata: dict, directory: str = None):
+    directory = directory or PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    _write(os.path.join(directory, f"{profile_id}.folded"), sampler.folded())
+    # Last, as list_profiles only lists profiles with metadata
+    _write(os.path.join(directory, f"{profile_id}.json"), json.dumps(metadata, indent=2))
+
+
+def list_profiles(directory: str = None) -> List[dict]:
+    """
+    Returns the metadata of the saved profiles, newest first, skipping files that cannot be read.
+    """
+    directory = directory or PROFILE_DIR
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".json"):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if isinstance(metadata, dict) and isinstance(metadata.get("started_at"), str):
+                profiles.append(metadata)
+    return sorted(profiles, key=lambda profile: profile["started_at"], reverse=True)
+
+
+def folded_path(profile_id: str, directory: str = None) -> Optional[str]:
+    path = os.path.join(directory or PROFILE_DIR, f"{profile_id}.folded")
+    return path if os.path.exists(path) else None
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        # Profiles report their queries even with METRICS_ENABLED=0
+        metrics.install_query_listeners()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        started_at = datetime.now().isoformat()
+        status = None
+        response_started = None
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+
+        async def recording_send(message):
+            nonlocal status, response_started
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_started = time.perf_counter()
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())])
+            await send(message)
+
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            with metrics.track_queries() as queries:
+                await self.app(scope, receive, recording_send)
+        finally:
+            finished = time.perf_counter()
+            sampler.stop()
+            await run_in_threadpool(save, profile_id, sampler, {
+                "id": profile_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": metrics.route_name(scope),
+                "user": _user(scope),
+                "status": status,
+                "started_at": started_at,
+                "duration_ms": round((finished - started) * 1000, 3),
+                "time_to_response_ms": round((response_started - started) * 1000, 3) if response_started else None,
+                "db_queries": queries.count,
+                "db_ms": round(queries.seconds * 1000, 3),
+                "samples": sampler.samples,
+                "interval_ms": PROFILE_INTERVAL_MS,
+            })
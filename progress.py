@@ -0,0 +1,175 @@
+"""
+Score trend analytics over a user's full assessment history.
+
+A TrendState holds running sums from which the trend metrics are read in O(1). It is built
+from a whole history with NumPy, then extended one assessment at a time as new ones arrive,
+so keeping a cached state current costs O(1) per new assessment rather than O(history).
+"""
+import math
+import os
+from datetime import datetime
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+MOVING_AVERAGE_WINDOW = int(os.getenv("TREND_MOVING_AVERAGE_WINDOW", 5))
+# Changes this many days old count half as much towards the time-weighted change
+TREND_HALF_LIFE_DAYS = float(os.getenv("TREND_HALF_LIFE_DAYS", 30))
+# Slopes and changes are reported per this many days
+TREND_PERIOD_DAYS = 30
+
+_SECONDS_PER_DAY = 86400.0
+
+
+def _days(timestamp: Optional[str]) -> Optional[float]:
+    """
+    Days since the epoch, or None for a timestamp that is missing or not ISO 8601.
+    """
+    try:
+        return datetime.fromisoformat(timestamp).timestamp() / _SECONDS_PER_DAY
+    except (TypeError, ValueError):
+        return None
+
+
+class TrendState:
+    """
+    Running statistics of a user's scores, ordered by assessment (timestamp, id).
+
+    `rows` passed to from_history and extend are (timestamp, id, score) tuples in that order;
+    rows without a score count towards `count` but not towards the statistics, and neither do
+    rows whose timestamp cannot be parsed, though their score is still in `score_sum`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.score_sum = 0
+        self.last_key = None
+        # Scored points, with times in days since the first one
+        self.t0 = None
+        self.n = 0
+        self.sum_t = self.sum_y = self.sum_tt = self.sum_ty = 0.0
+        self.diff_sum = self.diff_sumsq = 0.0
+        # Exponentially decayed sum of rates of change, see time_weighted_change
+        self.rate_ema = 0.0
+        self.recent = []
+        self.latest = None
+        self.previous = None
+
+    @classmethod
+    def from_history(cls, rows: Sequence[Tuple[str, int, Optional[int]]]) -> "TrendState":
+        state = cls()
+        if not rows:
+            return state
+        state.count = len(rows)
+        state.last_key = (rows[-1][0], rows[-1][1])
+        state.score_sum = sum(score for _, _, score in rows if score is not None)
+        scored = [(timestamp, score) for timestamp, _, score in rows if score is not None and _days(timestamp) is not None]
+        if not scored:
+            return state
+        t = np.array([_days(timestamp) for timestamp, _ in scored])
+        y = np.array([score for _, score in scored], dtype=np.float64)
+        state.t0 = t[0]
+        t = t - state.t0
+        state.n = len(y)
+        state.sum_t, state.sum_y = float(t.sum()), float(y.sum())
+        state.sum_tt, state.sum_ty = float(t @ t), float(t @ y)
+
+        dt, dy = np.diff(t), np.diff(y)
+        state.diff_sum, state.diff_sumsq = float(dy.sum()), float(dy @ dy)
+        rates = np.divide(dy, dt, out=np.zeros_like(dy), where=dt > 0)
+        # Each rate is weighted by (1 - its own decay) times the decay of all the time after it
+        weights = (1 - 0.5 ** (dt / TREND_HALF_LIFE_DAYS)) * 0.5 ** ((t[-1] - t[1:]) / TREND_HALF_LIFE_DAYS)
+        state.rate_ema = float(rates @ weights)
+
+        state.recent = [int(score) for score in y[-MOVING_AVERAGE_WINDOW:]]
+        state.latest = scored[-1]
+        state.previous = scored[-2] if len(scored) > 1 else None
+        return state
+
+    def extend(self, rows: Sequence[Tuple[str, int, Optional[int]]]) -> "TrendState":
+        """
+        Returns a new state that also covers `rows`, which must all sort after `last_key`.
+        """
+        state = self.copy()
+        for timestamp, assessment_id, score in rows:
+            state.count += 1
+            state.last_key = (timestamp, assessment_id)
+            if score is not None:
+                state.score_sum += score
+                days = _days(timestamp)
+                if days is not None:
+                    state._add_point(timestamp, days, score)
+        return state
+
+    def _add_point(self, timestamp: str, days: float, score: int):
+        if self.t0 is None:
+            self.t0 = days
+        t = days - self.t0
+        if self.latest is not None:
+            last_t = _days(self.latest[0]) - self.t0
+            dt, dy = t - last_t, score - self.latest[1]
+            self.diff_sum += dy
+            self.diff_sumsq += dy * dy
+            decay = 0.5 ** (dt / TREND_HALF_LIFE_DAYS)
+            self.rate_ema = self.rate_ema * decay + (1 - decay) * (dy / dt if dt > 0 else 0.0)
+        self.n += 1
+        self.sum_t += t
+        self.sum_y += score
+        self.sum_tt += t * t
+        self.sum_ty += t * score
+        self.recent = (self.recent + [score])[-MOVING_AVERAGE_WINDOW:]
+        self.previous, self.latest = self.latest, (timestamp, score)
+
+    def copy(self) -> "TrendState":
+        state = TrendState.__new__(TrendState)
+        state.__dict__.update(self.__dict__)
+        state.recent = list(self.recent)
+        return state
+
+    @property
+    def moving_average(self) -> Optional[float]:
+        return sum(self.recent) / len(self.recent) if self.recent else None
+
+    @property
+    def slope(self) -> Optional[float]:
+        """
+        Least-squares change in score per TREND_PERIOD_DAYS over the whole history.
+        """
+        denominator = self.n * self.sum_tt - self.sum_t ** 2
+        if self.n < 2 or denominator <= 1e-9 * max(self.n * self.sum_tt, 1.0):
+            return None
+        return (self.n * self.sum_ty - self.sum_t * self.sum_y) / denominator * TREND_PERIOD_DAYS
+
+    @property
+    def volatility(self) -> Optional[float]:
+        """
+        Standard deviation of the change from one assessment to the next.
+        """
+        if self.n < 2:
+            return None
+        mean = self.diff_sum / (self.n - 1)
+        return math.sqrt(max(self.diff_sumsq / (self.n - 1) - mean * mean, 0.0))
+
+    @property
+    def time_weighted_change(self) -> Optional[float]:
+        """
+        Average rate of change per TREND_PERIOD_DAYS, weighting recent changes more.
+        """
+        if self.n < 2:
+            return None
+        span = _days(self.latest[0]) - self.t0
+        total_weight = 1 - 0.5 ** (span / TREND_HALF_LIFE_DAYS)
+        if total_weight <= 0:
+            return None
+        return self.rate_ema / total_weight * TREND_PERIOD_DAYS
+
+    def to_dict(self) -> dict:
+        def rounded(value):
+            return None if value is None else round(value, 3)
+        return {
+            "assessments": self.n,
+            "moving_average": rounded(self.moving_average),
+            "slope": rounded(self.slope),
+            "volatility": rounded(self.volatility),
+            "time_weighted_change": rounded(self.time_weighted_change),
+        }
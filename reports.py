@@ -0,0 +1,209 @@
+"""
+Questionnaire report engine.
+
+The text pools and answer rules are plain tables compiled once at import. Reports are scored
+in batches with NumPy, and every random draw is derived from a per-report seed with a
+counter-based generator, so a report depends only on its questionnaire and seed: the same
+pair gives the same report whether it is scored alone or as part of any batch.
+
+Bump RULES_VERSION whenever the tables or scoring change, so stored reports made with older
+rules can be found and re-scored.
+"""
+import secrets
+import time
+from collections.abc import Hashable
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from . import metrics
+
+RULES_VERSION = 1
+
+SCORE_RANGE = (30, 80)
+# Scores below each threshold get the severity on its left
+SEVERITY_THRESHOLDS = [50, 70]
+SEVERITIES = ["Severe", "Moderate", "Mild"]
+KEY_FINDINGS_COUNT = (2, 4)
+RECOMMENDATIONS_COUNT = (2, 3)
+
+KEY_FINDINGS = [
+    "Noticeable thinning in the crown area.",
+    "The scalp appears to be in good condition, with no visible irritation.",
+    "Some dryness and flakiness is visible on the scalp.",
+    "Hair appears to be well-hydrated and has good elasticity.",
+    "A moderate amount of dandruff flakes were observed across the scalp.",
+    "No significant inflammation or redness was detected.",
+    "Hair follicles appear open and are not clogged.",
+    "The hair seems brittle and prone to breakage.",
+    "Scalp oiliness is within a normal range.",
+]
+
+RECOMMENDATIONS = [
+    "Ensure a diet rich in iron, zinc, and B-vitamins to support hair growth.",
+    "Incorporate regular scalp massages to improve blood circulation to the follicles.",
+    "Avoid harsh chemical treatments and excessive heat styling for a few weeks.",
+    "Switch to a gentle, sulfate-free shampoo to avoid stripping natural oils.",
+    "Consider using a silk or satin pillowcase to reduce hair friction and breakage overnight.",
+    "Stay hydrated by drinking an adequate amount of water throughout the day.",
+    "Look into mindfulness or meditation to help manage stress levels.",
+    "A weekly deep conditioning treatment could improve hair moisture.",
+]
+
+DEFAULT_DIAGNOSIS = "General hair health analysis."
+
+
+class Rule(NamedTuple):
+    """
+    Matches when answer `key` equals one of `values`, or contains `contains` (case-insensitively).
+    `text` may refer to the answer as {value}.
+    """
+    key: str
+    text: str
+    values: tuple = ()
+    contains: Optional[str] = None
+
+
+FINDING_RULES = [
+    Rule("scalp_condition", "The scalp is reported as Itchy or flaky, which may be a contributing factor to hair health.",
+         values=("Itchy or flaky",)),
+    Rule("stress_level", "Reported stress level is {value}, which can impact hair health.",
+         values=("Very stressed", "Moderately stressed")),
+]
+
+# The first matching rule gives the diagnosis
+DIAGNOSIS_RULES = [
+    Rule("family_hair_loss_history", "Potential for Androgenetic Alopecia based on family history.", values=("Yes",)),
+    Rule("main_hair_concern", "Telogen Effluvium (stress-related shedding) is a possibility based on your concerns.",
+         contains="hair loss"),
+]
+
+RECOMMENDATION_RULES = [
+    Rule("main_hair_concern", "For hair loss concerns, consider a topical minoxidil treatment after consulting a specialist.",
+         contains="hair loss"),
+    Rule("diet", "Your diet may be impacting your hair. Consulting a nutritionist for a personalized plan is highly recommended.",
+         values=("Poor (skips meals, low nutrients)",)),
+]
+
+
+class _CompiledRule:
+    def __init__(self, rule: Rule):
+        self.key = rule.key
+        self.text = rule.text
+        self.templated = "{value}" in rule.text
+        self.values = frozenset(rule.values)
+        self.contains = rule.contains.lower() if rule.contains else None
+
+    def matches(self, value) -> bool:
+        if self.contains is not None:
+            return isinstance(value, str) and self.contains in value.lower()
+        # Answers are client JSON, so may be lists or dicts, which never match
+        return isinstance(value, Hashable) and value in self.values
+
+    def render(self, value) -> str:
+        return self.text.format(value=value) if self.templated else self.text
+
+
+_FINDING_RULES = [_CompiledRule(rule) for rule in FINDING_RULES]
+_DIAGNOSIS_RULES = [_CompiledRule(rule) for rule in DIAGNOSIS_RULES]
+_RECOMMENDATION_RULES = [_CompiledRule(rule) for rule in RECOMMENDATION_RULES]
+_DIAGNOSES = np.array([rule.text for rule in _DIAGNOSIS_RULES] + [DEFAULT_DIAGNOSIS], dtype=object)
+_SEVERITIES = np.array(SEVERITIES, dtype=object)
+
+# Each report draws one number from each of these independent streams
+_SCORE_STREAM = 0
+_FINDINGS_COUNT_STREAM = 1
+_RECOMMENDATIONS_COUNT_STREAM = 2
+_FINDINGS_ORDER_STREAMS = slice(3, 3 + len(KEY_FINDINGS))
+_RECOMMENDATIONS_ORDER_STREAMS = slice(_FINDINGS_ORDER_STREAMS.stop, _FINDINGS_ORDER_STREAMS.stop + len(RECOMMENDATIONS))
+_STREAM_OFFSETS = (np.arange(1, _RECOMMENDATIONS_ORDER_STREAMS.stop + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+
+def _uniform(seeds: np.ndarray) -> np.ndarray:
+    """
+    Returns a (len(seeds), streams) array of floats in [0, 1), using SplitMix64.
+    """
+    with np.errstate(over="ignore"):
+        z = seeds[:, None] + _STREAM_OFFSETS[None, :]
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def _integers(draws: np.ndarray, low: int, high: int) -> np.ndarray:
+    """
+    Maps uniform draws to integers in [low, high].
+    """
+    return low + (draws * (high - low + 1)).astype(np.int64)
+
+
+def _sample(keys: np.ndarray, counts: np.ndarray) -> List[List[int]]:
+    """
+    Picks `counts[i]` distinct column indices for each row of random `keys`, in random order.
+    """
+    order = np.argsort(keys, axis=1)
+    return [row[:count] for row, count in zip(order.tolist(), counts.tolist())]
+
+
+def _matches(rules: List[_CompiledRule], answers: List[dict]) -> np.ndarray:
+    return np.array([[rule.matches(a.get(rule.key)) for rule in rules] for a in answers], dtype=bool).reshape(len(answers), len(rules))
+
+
+def new_seed() -> int:
+    return secrets.randbits(63)
+
+
+def generate_reports(questionnaires: Sequence[dict], seeds: Optional[Sequence[int]] = None) -> List[dict]:
+    """
+    Scores many questionnaires at once. Each report has severity, key_findings, diagnosis,
+    recommendations and score keys. Without `seeds`, each report gets a random one.
+    """
+    started = time.perf_counter()
+    n = len(questionnaires)
+    if seeds is None:
+        seeds = [new_seed() for _ in range(n)]
+    seeds = np.array([seed % 2**64 for seed in seeds], dtype=np.uint64)
+    answers = [questionnaire.get("answers") if isinstance(questionnaire, dict) else None for questionnaire in questionnaires]
+    answers = [answer if isinstance(answer, dict) else {} for answer in answers]
+
+    draws = _uniform(seeds)
+
+    scores = _integers(draws[:, _SCORE_STREAM], *SCORE_RANGE)
+    severities = _SEVERITIES[np.digitize(scores, SEVERITY_THRESHOLDS)]
+
+    diagnosis_matches = _matches(_DIAGNOSIS_RULES, answers)
+    # Index of the first matching rule, or the default when none match
+    first_match = np.where(diagnosis_matches.any(axis=1), diagnosis_matches.argmax(axis=1), len(_DIAGNOSIS_RULES))
+    diagnoses = _DIAGNOSES[first_match]
+
+    findings = _sample(draws[:, _FINDINGS_ORDER_STREAMS],
+                       _integers(draws[:, _FINDINGS_COUNT_STREAM], *KEY_FINDINGS_COUNT))
+    recommendations = _sample(draws[:, _RECOMMENDATIONS_ORDER_STREAMS],
+                              _integers(draws[:, _RECOMMENDATIONS_COUNT_STREAM], *RECOMMENDATIONS_COUNT))
+    finding_matches = _matches(_FINDING_RULES, answers)
+    recommendation_matches = _matches(_RECOMMENDATION_RULES, answers)
+
+    # Plain lists, since indexing NumPy arrays one element at a time is slow
+    severities, diagnoses, scores = severities.tolist(), diagnoses.tolist(), scores.tolist()
+    finding_matches, recommendation_matches = finding_matches.tolist(), recommendation_matches.tolist()
+    reports = []
+    for i in range(n):
+        key_findings = [KEY_FINDINGS[j] for j in findings[i]]
+        key_findings += [rule.render(answers[i].get(rule.key)) for rule, hit in zip(_FINDING_RULES, finding_matches[i]) if hit]
+        report_recommendations = [RECOMMENDATIONS[j] for j in recommendations[i]]
+        report_recommendations += [rule.render(answers[i].get(rule.key)) for rule, hit in zip(_RECOMMENDATION_RULES, recommendation_matches[i]) if hit]
+        reports.append({
+            "severity": severities[i],
+            "key_findings": list(dict.fromkeys(key_findings)),
+            "diagnosis": diagnoses[i],
+            "recommendations": list(dict.fromkeys(report_recommendations)),
+            "score": scores[i],
+        })
+    metrics.report_generation_duration.observe(time.perf_counter() - started)
+    metrics.reports_generated.inc(amount=n)
+    return reports
+
+
+def generate_report(questionnaire: dict, seed: Optional[int] = None) -> dict:
+    return generate_reports([questionnaire], seeds=None if seed is None else [seed])[0]
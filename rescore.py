@@ -0,0 +1,211 @@
+"""
+Re-scores stored assessments whose reports were made with older rules than reports.RULES_VERSION.
+
+Stale assessments are read in id order one chunk at a time and scored on a process pool while
+the next chunks are read. Results are written back in id order with one executemany UPDATE per
+chunk, which also records the rules version on each row, so an interrupted run simply picks up
+the rows it had not reached when started again.
+
+    python -m package.rescore --workers 8
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional
+
+from sqlalchemy import bindparam, func, or_, select, update
+
+from . import database, models, reports
+
+RESCORE_CHUNK_SIZE = int(os.getenv("RESCORE_CHUNK_SIZE", 2000))
+RESCORE_WORKERS = int(os.getenv("RESCORE_WORKERS", os.cpu_count() or 1))
+
+_assessments = models.Assessment.__table__
+_summaries = models.UserSummary.__table__
+
+
+class RescoreProgress:
+    def __init__(self, total: int, rules_version: int):
+        self.total = total
+        self.rules_version = rules_version
+        self.done = 0
+        self.last_id = None
+        self.status = "running"
+        self.error = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return {
+            "status": self.status,
+            "rules_version": self.rules_version,
+            "total": self.total,
+            "done": self.done,
+            "last_id": self.last_id,
+            "rows_per_second": round(rate, 1),
+            "eta_seconds": round((self.total - self.done) / rate, 1) if rate and self.status == "running" else None,
+            "error": self.error,
+        }
+
+
+def _is_stale(rules_version: int):
+    return or_(_assessments.c.rules_version.is_(None), _assessments.c.rules_version != rules_version)
+
+
+def count_stale(engine, rules_version: int = reports.RULES_VERSION, after_id: int = 0) -> int:
+    with engine.connect() as connection:
+        return connection.execute(
+            select(func.count()).where(_assessments.c.id > after_id, _is_stale(rules_version))
+        ).scalar()
+
+
+def stale_chunks(engine, chunk_size: int, rules_version: int = reports.RULES_VERSION, after_id: int = 0) -> Iterator[list]:
+    """
+    Yields lists of (id, owner_id, questionnaire, analysis_results) for stale assessments, in id order.
+    """
+    columns = [_assessments.c.id, _assessments.c.owner_id, _assessments.c.questionnaire, _assessments.c.analysis_results]
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(*columns)
+                .where(_assessments.c.id > after_id, _is_stale(rules_version))
+                .order_by(_assessments.c.id)
+                .limit(chunk_size)
+            ).all()
+        if rows:
+            yield [tuple(row) for row in rows]
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1][0]
+
+
+def score_chunk(rows: list) -> List[dict]:
+    """
+    Scores a chunk from stale_chunks, keeping each row's report seed and scalp analysis.
+
+    Rows from before report seeds were stored are seeded with their id.
+    """
+    previous = [results if isinstance(results, dict) else {} for _, _, _, results in rows]
+    seeds = [results.get("report_seed", assessment_id) for (assessment_id, _, _, _), results in zip(rows, previous)]
+    questionnaires = [questionnaire if isinstance(questionnaire, dict) else {} for _, _, questionnaire, _ in rows]
+    updates = []
+    for (assessment_id, _, _, _), old, seed, report in zip(rows, previous, seeds, reports.generate_reports(questionnaires, seeds)):
+        report["report_seed"] = seed
+        if "scalp_analysis" in old:
+            report["scalp_analysis"] = old["scalp_analysis"]
+        updates.append({"_id": assessment_id, "_results": report})
+    return updates
+
+
+def _write_chunk(engine, rows: list, updates: List[dict], rules_version: int):
+    statement = (
+        update(_assessments)
+        .where(_assessments.c.id == bindparam("_id"))
+        .values(analysis_results=bindparam("_results", type_=_assessments.c.analysis_results.type), rules_version=rules_version)
+    )
+    with engine.begin() as connection:
+        connection.execute(statement, updates)
+        # Scores changed, so drop the owners' summaries for crud.get_user_summary to rebuild
+        owner_ids = {owner_id for _, owner_id, _, _ in rows}
+        connection.execute(_summaries.delete().where(_summaries.c.user_id.in_(owner_ids)))
+
+
+def rescore(engine, workers: int = RESCORE_WORKERS, chunk_size: int = RESCORE_CHUNK_SIZE, after_id: int = 0,
+            progress: Optional[RescoreProgress] = None, on_chunk: Optional[Callable[[RescoreProgress], None]] = None) -> RescoreProgress:
+    """
+    Re-scores every stale assessment with an id above `after_id`. With `workers=0` chunks are
+    scored in this process.
+    """
+    rules_version = reports.RULES_VERSION
+    if progress is None:
+        progress = RescoreProgress(total=count_stale(engine, rules_version, after_id), rules_version=rules_version)
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        # Chunks being scored, oldest first, so they are written in id order
+        in_flight = deque()
+
+        def write_oldest():
+            rows, scored = in_flight.popleft()
+            _write_chunk(engine, rows, scored.result() if executor else scored, rules_version)
+            progress.done += len(rows)
+            progress.last_id = rows[-1][0]
+            if on_chunk:
+                on_chunk(progress)
+
+        for rows in stale_chunks(engine, chunk_size, rules_version, after_id):
+            in_flight.append((rows, executor.submit(score_chunk, rows) if executor else score_chunk(rows)))
+            if len(in_flight) > max(workers, 1) * 2:
+                write_oldest()
+        while in_flight:
+            write_oldest()
+    except BaseException as exc:
+        progress.status = "failed"
+        progress.error = str(exc) or exc.__class__.__name__
+        raise
+    else:
+        progress.status = "completed"
+    finally:
+        progress.finished_at = time.monotonic()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return progress
+
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def start_background(engine, workers: int = RESCORE_WORKERS, chunk_size: int = RESCORE_CHUNK_SIZE) -> RescoreProgress:
+    """
+    Starts a re-scoring run on a background thread, or returns the progress of the one already running.
+    """
+    global _background
+    with _background_lock:
+        if _background is not None and _background.status == "running":
+            return _background
+        rules_version = reports.RULES_VERSION
+        _background = RescoreProgress(total=count_stale(engine, rules_version), rules_version=rules_version)
+        progress = _background
+
+    def run():
+        try:
+            rescore(engine, workers=workers, chunk_size=chunk_size, progress=progress)
+        except Exception:
+            pass  # Recorded on the progress
+
+    threading.Thread(target=run, name="rescore", daemon=True).start()
+    return progress
+
+
+def background_progress() -> Optional[RescoreProgress]:
+    return _background
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-score assessments made with older report rules.")
+    parser.add_argument("--workers", type=int, default=RESCORE_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=RESCORE_CHUNK_SIZE)
+    parser.add_argument("--after-id", type=int, default=0, help="skip assessments up to this id")
+    args = parser.parse_args(argv)
+
+    def report(progress):
+        state = progress.to_dict()
+        print(f"{state['done']}/{state['total']} rescored, last id {state['last_id']}, "
+              f"{state['rows_per_second']} rows/s, eta {state['eta_seconds']}s", file=sys.stderr)
+
+    models.ensure_schema(database.engine)
+    progress = rescore(database.engine, workers=args.workers, chunk_size=args.chunk_size, after_id=args.after_id, on_chunk=report)
+    print(f"Rescored {progress.done} assessments with rules version {progress.rules_version}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
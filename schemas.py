@@ -8,14 +8,16 @@ class AssessmentBase(BaseModel):
     timestamp: str
 
 class AssessmentCreate(AssessmentBase):
-    pass
+    rules_version: Optional[int] = None
 
 class Assessment(AssessmentBase):
     id: int
     owner_id: int
+    scalp_photo_variants: Dict[str, str] = {}
 
     class Config:
         orm_mode = True
+        from_attributes = True
 
 class UserBase(BaseModel):
     email: str
@@ -37,6 +39,17 @@ class User(UserBase):
 
     class Config:
         orm_mode = True
+        from_attributes = True
+
+class UserListItem(UserBase):
+    """
+    A user without their assessments, so a page of users stays bounded in size.
+    """
+    profile_photo_url: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+        from_attributes = True
 
 class UserLogin(BaseModel):
     email: str
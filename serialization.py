@@ -0,0 +1,38 @@
+"""
+Fast JSON serialization for the large assessment payloads.
+
+Rows are turned into plain dicts with the same fields as schemas.Assessment and encoded
+with orjson. This skips the pydantic model built per row and FastAPI's second validation
+and jsonable_encoder pass over the response. The JSON columns are passed to the encoder
+as they are, without copying.
+"""
+from typing import Any
+
+import orjson
+from starlette.responses import Response
+
+from . import models
+from .derivatives import variant_urls
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def assessment_dict(assessment: models.Assessment) -> dict:
+    return {
+        "questionnaire": assessment.questionnaire,
+        "scalp_photo_url": assessment.scalp_photo_url,
+        "analysis_results": assessment.analysis_results,
+        "timestamp": assessment.timestamp,
+        "id": assessment.id,
+        "owner_id": assessment.owner_id,
+        "scalp_photo_variants": variant_urls(assessment.scalp_photo_url),
+    }
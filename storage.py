@@ -0,0 +1,108 @@
+import os
+import uuid
+from typing import NamedTuple, Optional
+
+from fastapi import UploadFile
+from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+from . import uploads
+
+STORE_DIR = os.getenv("PHOTO_STORE_DIR", "photo_store")
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Magic numbers of the image formats the mobile app sends, mapped to the
+# extension the blob is stored under so StaticFiles serves the right media type.
+_SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+_ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic"}
+
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    path: str
+    size: int
+    content_type: Optional[str]
+
+
+def _sniff_extension(header: bytes, filename: Optional[str]) -> str:
+    for signature, extension in _SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp"
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".jpeg":
+        return ".jpg"
+    return extension if extension in _ALLOWED_EXTENSIONS else ""
+
+
+def blob_path(sha256: str, extension: str = "") -> str:
+    """
+    Returns the store-relative path of a blob, fanned out over two directory levels.
+    """
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+
+def photo_url(mount: str, blob: StoredBlob) -> str:
+    return f"/{mount}/{blob.path}"
+
+
+def _read_header(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(16)
+
+
+def _commit_blob(partial_path: str, full_path: str):
+    if os.path.exists(full_path):
+        # Same bytes are already stored, drop the duplicate.
+        os.remove(partial_path)
+        return
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    os.replace(partial_path, full_path)
+
+
+async def store_upload(file: UploadFile) -> StoredBlob:
+    """
+    Streams an upload into the content-addressed store and returns the blob it maps to.
+
+    Uploading bytes that are already stored leaves the existing blob untouched.
+    """
+    incoming_dir = os.path.join(STORE_DIR, "incoming")
+    await run_in_threadpool(os.makedirs, incoming_dir, exist_ok=True)
+    saved = await uploads.save_upload(file, os.path.join(incoming_dir, uuid.uuid4().hex))
+    header = await run_in_threadpool(_read_header, saved.path)
+    path = blob_path(saved.sha256, _sniff_extension(header, file.filename))
+    await run_in_threadpool(_commit_blob, saved.path, os.path.join(STORE_DIR, path))
+    return StoredBlob(sha256=saved.sha256, path=path, size=saved.size, content_type=file.content_type)
+
+
+class PhotoStaticFiles(StaticFiles):
+    """
+    Serves blobs from the photo store with immutable cache headers.
+
+    Paths that are not in the store are looked up in `legacy_directory`, which holds
+    photos uploaded before the store existed.
+    """
+
+    def __init__(self, legacy_directory: Optional[str] = None):
+        super().__init__(directory=STORE_DIR, check_dir=False)
+        self.legacy = StaticFiles(directory=legacy_directory, check_dir=False) if legacy_directory else None
+
+    async def get_response(self, path, scope):
+        if path.startswith("incoming"):
+            raise StarletteHTTPException(status_code=404)
+        try:
+            response = await super().get_response(path, scope)
+        except StarletteHTTPException as exc:
+            if exc.status_code != 404 or self.legacy is None:
+                raise
+            return await self.legacy.get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = CACHE_CONTROL
+        return response
@@ -0,0 +1,83 @@
+import hashlib
+import os
+from typing import NamedTuple, Optional
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 10 * 1024 * 1024))
+
+
+class SavedUpload(NamedTuple):
+    path: str
+    size: int
+    sha256: str
+
+
+def _write_chunk(buffer, digest, chunk: bytes):
+    digest.update(chunk)
+    buffer.write(chunk)
+
+
+def _discard(buffer, path: str):
+    buffer.close()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+async def save_upload(file: UploadFile, destination: str, max_size: Optional[int] = None) -> SavedUpload:
+    """
+    Streams an uploaded file to `destination` in chunks without blocking the event loop.
+
+    The bytes are hashed as they are written and the upload is aborted with a 413 as soon
+    as it grows past `max_size`. The file is written next to its destination first and only
+    moved into place once it is complete, so a failed upload never leaves a partial file.
+    """
+    if max_size is None:
+        max_size = MAX_UPLOAD_SIZE
+    if file.size is not None and file.size > max_size:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    partial_path = f"{destination}.part"
+    digest = hashlib.sha256()
+    size = 0
+    buffer = await run_in_threadpool(open, partial_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(status_code=413, detail="File too large")
+            await run_in_threadpool(_write_chunk, buffer, digest, chunk)
+    except BaseException:
+        await run_in_threadpool(_discard, buffer, partial_path)
+        raise
+    await run_in_threadpool(buffer.close)
+    await run_in_threadpool(os.replace, partial_path, destination)
+    return SavedUpload(path=destination, size=size, sha256=digest.hexdigest())
+
+
+async def read_upload(file: UploadFile, max_size: Optional[int] = None) -> bytes:
+    """
+    Reads an uploaded file into memory in chunks, with the same 413 as save_upload once it
+    grows past `max_size`, for uploads that are processed but not kept.
+    """
+    if max_size is None:
+        max_size = MAX_UPLOAD_SIZE
+    if file.size is not None and file.size > max_size:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(status_code=413, detail="File too large")
+        chunks.append(chunk)
+    return b"".join(chunks)